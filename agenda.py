@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+""" Materialized conference agendas
+
+A conference's agenda holds the SessionForm fields of all its sessions in
+one AgendaDay per day, keyed by the date ('undated' for sessions without
+one), sorted by start time. New sessions are added to the AgendaDays of
+their dates in the transaction that stores them, so getConferenceSessions
+reads a few entities however many sessions there are, and creating a
+session rewrites only its own day. The Agenda entity marks the days as
+built; agendas of conferences whose sessions predate them are built on
+first read."""
+
+from google.appengine.ext import ndb
+
+from models import Agenda
+from models import AgendaDay
+from models import Session
+
+from serializers import SESSION_PLAN
+
+AGENDA_ID = 'days'
+# the key of the single entity agendas were kept in before they were
+# split by day
+LEGACY_AGENDA_ID = 'agenda'
+UNDATED = 'undated'
+
+
+def agendaKey(c_key):
+    """Return the Agenda key of a conference."""
+    return ndb.Key(Agenda, AGENDA_ID, parent=c_key)
+
+
+def agendaDayKeys(c_key, sessions):
+    """Return the keys of the AgendaDays of the dates of sessions."""
+    return [ndb.Key(AgendaDay, day_id, parent=c_key)
+            for day_id in sorted(set(
+                str(session.date) if session.date else UNDATED
+                for session in sessions))]
+
+
+def _sessionOrder(fields):
+    # SessionForm fields are strings, 'None' when not set
+    start = fields['startTime']
+    return (start == 'None', start, fields['name'])
+
+
+def _dayOrder(day):
+    day_id = day.key.id()
+    return (day_id == UNDATED, day_id)
+
+
+def newAgenda(c_key, sessions):
+    """Return a new Agenda of a conference and its AgendaDays by id,
+    holding sessions.
+
+    The caller is responsible for putting them."""
+    days = {}
+    addSessions(c_key, days, sessions)
+    return Agenda(key=agendaKey(c_key)), days
+
+
+def addSessions(c_key, days, sessions):
+    """Add sessions to the AgendaDays by id in days, adding the days
+    missing, and return the days changed."""
+    new = {}
+    for session in sessions:
+        fields = SESSION_PLAN.values(session)
+        day_id = fields['date'] if fields['date'] != 'None' else UNDATED
+        new.setdefault(day_id, []).append(fields)
+    for day_id, fields in new.items():
+        if day_id not in days:
+            days[day_id] = AgendaDay(id=day_id, parent=c_key, sessions=[])
+        # already sorted but for the new sessions, which sort() merges in
+        # about linear time
+        days[day_id].sessions.extend(fields)
+        days[day_id].sessions.sort(key=_sessionOrder)
+    return [days[day_id] for day_id in new]
+
+
+@ndb.transactional
+def _buildAgenda(c_key):
+    agenda, days = agendaKey(c_key).get(), None
+    if not agenda:
+        agenda, days = newAgenda(c_key, Session.query(ancestor=c_key).fetch())
+        # drop days left from an agenda deleted to be built again
+        stale = [key for key in AgendaDay.query(ancestor=c_key).fetch(
+                 keys_only=True) if key.id() not in days]
+        ndb.delete_multi(stale + [ndb.Key(Agenda, LEGACY_AGENDA_ID,
+                                          parent=c_key)])
+        ndb.put_multi([agenda] + days.values())
+        days = days.values()
+    else:
+        days = AgendaDay.query(ancestor=c_key).fetch()
+    return sorted(days, key=_dayOrder)
+
+
+def getAgenda(c_key):
+    """Return the AgendaDays of a conference in date order, building them
+    if there are none, or None if c_key is not of a stored Conference."""
+    if c_key.kind() != 'Conference':
+        return None
+    conf, agenda = ndb.get_multi_async([c_key, agendaKey(c_key)])
+    days = AgendaDay.query(ancestor=c_key).fetch_async()
+    if not conf.get_result():
+        return None
+    if not agenda.get_result():
+        return _buildAgenda(c_key)
+    return sorted(days.get_result(), key=_dayOrder)
+
+
+def agendaSessions(days, typeOfSession=None):
+    """Return the SessionForm fields of the sessions in the AgendaDays
+    days, in order, only those of typeOfSession if given."""
+    return [fields for day in days for fields in day.sessions
+            if typeOfSession is None or
+            fields['typeOfSession'] == typeOfSession]
@@ -1,4 +1,9 @@
+# Per-method numbers come from stats.py; appstats only traces a sample of
+# requests, as recording every one is too heavy for production.
+appstats_RECORD_FRACTION = 0.01
+
+
 def webapp_add_wsgi_middleware(app):
   from google.appengine.ext.appstats import recording
   app = recording.appstats_wsgi_middleware(app)
-  return app
\ No newline at end of file
+  return app
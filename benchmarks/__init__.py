@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+""" Offline benchmarks for Conference Central
+
+Run the modules in this package from the application directory with the
+path to the App Engine SDK, e.g.
+`python -m benchmarks.copy_plans ~/google_appengine`. The helpers here
+are shared with the tests."""
+
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setupSdk(sdk_path):
+    """Put the App Engine SDK, its bundled libraries and the application
+    on sys.path."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault('APPLICATION_ID', 'dev~conference-bench')
+    os.environ.setdefault('CURRENT_VERSION_ID', 'bench.1')
+
+
+def activateStubs():
+    """Activate a testbed of local stand-ins for the APIs the application
+    uses, returning it to deactivate."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # queries see all writes at once, as if every index were up to date
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=REPO_DIR)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_user_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+def asUser(email):
+    """Make email the endpoints user of the following calls."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Benchmark: confirmation email digests through the pull queue
+
+Queues confirmations for a bulk import on the local task queue stub and
+sends them to a LocalMailer that takes LATENCY seconds per mail.
+
+usage: python -m benchmarks.confirmation_email SDK_PATH [RECORDS]"""
+
+import datetime
+import sys
+import time
+
+from benchmarks import REPO_DIR
+from benchmarks import setupSdk
+
+ORGANIZERS = 20
+LATENCY = 0.05
+
+
+def queueRecords(records):
+    """Queue records confirmations spread over ORGANIZERS organizers."""
+    from emails import enqueueConfirmation
+    from models import Conference
+
+    start = datetime.date(2026, 1, 1)
+    for i in range(records):
+        enqueueConfirmation(
+            'organizer%d@example.com' % (i % ORGANIZERS),
+            Conference(name='Conference %d' % i, city='London',
+                       startDate=start, endDate=start, maxAttendees=100,
+                       topics=['Web']))
+
+
+def main(sdk_path, records=1000):
+    setupSdk(sdk_path)
+    from google.appengine.ext import testbed
+    from emails import LocalMailer
+    from emails import sendConfirmations
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_app_identity_stub()
+    bed.init_taskqueue_stub(root_path=REPO_DIR)
+
+    print '%-12s %8s %8s %10s %10s' % (
+        'concurrency', 'records', 'digests', 'records/s', 'seconds')
+    for concurrency in (1, 4, 8):
+        queueRecords(records)
+        mailer = LocalMailer(latency=LATENCY)
+        started = time.time()
+        digests = 0
+        while True:
+            sent = sendConfirmations(mailer, concurrency)
+            if not sent:
+                break
+            digests += sent
+        seconds = time.time() - started
+        print '%-12d %8d %8d %10.0f %10.2f' % (
+            concurrency, records, digests, records / seconds, seconds)
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
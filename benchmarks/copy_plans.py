@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+""" Micro-benchmark: entity to message copying, per-field loop vs CopyPlan
+
+usage: python -m benchmarks.copy_plans SDK_PATH [ROWS]"""
+
+import datetime
+import sys
+import time
+
+from benchmarks import setupSdk
+
+
+# The per-field loops used before serializers.py, kept as the baseline.
+
+def legacyConferenceToForm(conf, displayName):
+    from models import ConferenceForm
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def legacySessionToForm(session):
+    from models import SessionForm
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(session, field.name):
+            setattr(sf, field.name, str(getattr(session, field.name)))
+        if field.name == "websafeSessionKey":
+            setattr(sf, field.name, session.key.urlsafe())
+        if field.name == "websafeConferenceKey":
+            setattr(sf, field.name, session.key.parent().urlsafe())
+    sf.check_initialized()
+    return sf
+
+
+def makeRows(rows):
+    """Return rows unsaved Conference and Session entities."""
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Profile
+    from models import Session
+
+    p_key = ndb.Key(Profile, 'organizer@example.com')
+    start = datetime.date(2026, 1, 1)
+    conferences = [
+        Conference(key=ndb.Key(Conference, i + 1, parent=p_key),
+                   name='Conference %d' % i, description='x' * 200,
+                   organizerUserId=p_key.id(), topics=['Web', 'Cloud'],
+                   city='London', startDate=start, month=start.month,
+                   endDate=start + datetime.timedelta(days=2),
+                   maxAttendees=100, seatsAvailable=50)
+        for i in range(rows)]
+    sessions = [
+        Session(key=ndb.Key(Session, i + 1, parent=conferences[0].key),
+                name='Session %d' % i, highlights='x' * 200,
+                speaker='Speaker %d' % (i % 50), duration='60',
+                typeOfSession='Lecture', date=start,
+                startTime=datetime.time(9 + i % 8, 0))
+        for i in range(rows)]
+    return conferences, sessions
+
+
+def timeIt(fn, rows):
+    """Return rows per second for one call of fn."""
+    started = time.time()
+    fn()
+    return rows / (time.time() - started)
+
+
+def main(sdk_path, rows=10000):
+    setupSdk(sdk_path)
+    from serializers import CONFERENCE_PLAN
+    from serializers import SESSION_PLAN
+
+    conferences, sessions = makeRows(rows)
+    cases = [
+        ('Conference', 'per-field loop',
+         lambda: [legacyConferenceToForm(c, '') for c in conferences]),
+        ('Conference', 'CopyPlan.copy',
+         lambda: [CONFERENCE_PLAN.copy(c) for c in conferences]),
+        ('Conference', 'CopyPlan.copyMulti',
+         lambda: CONFERENCE_PLAN.copyMulti(conferences)),
+        ('Session', 'per-field loop',
+         lambda: [legacySessionToForm(s) for s in sessions]),
+        ('Session', 'CopyPlan.copy',
+         lambda: [SESSION_PLAN.copy(s) for s in sessions]),
+        ('Session', 'CopyPlan.copyMulti',
+         lambda: SESSION_PLAN.copyMulti(sessions)),
+    ]
+    print '%-12s %-20s %12s' % ('model', 'copy', 'entities/s')
+    for model, name, fn in cases:
+        print '%-12s %-20s %12.0f' % (model, name, timeIt(fn, rows))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+""" Load test: every ConferenceApi endpoint and main.py handler on local stubs
+
+Seeds the local datastore stub with profiles, conferences (with their seat
+shards) and sessions, then calls each endpoint and handler CALLS times,
+or fewer for the slowest (see SCENARIO_CALLS), as a fresh request each
+time with memcache flushed. Reports ops/s,
+latency percentiles and datastore RPCs per call, and exits with status 1
+if a result regressed past the stored baseline for the same volumes.
+
+Ops/s depend on the machine, so they are compared as ratios to the ops/s
+of a fixed reference workload measured in the same run.
+
+usage: python -m benchmarks.load_test SDK_PATH [--profiles N]
+           [--conferences N] [--sessions N] [--calls N] [--tolerance F]
+           [--baseline PATH] [--update-baseline]
+
+The defaults run in a couple of minutes; e.g. --conferences 10000
+--sessions 200000 for production sized volumes."""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+from benchmarks import REPO_DIR
+from benchmarks import activateStubs
+from benchmarks import asUser
+from benchmarks import setupSdk
+
+BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'load_test_baseline.json')
+CITIES = ['London', 'Paris', 'Berlin', 'Tokyo', 'Chicago']
+TOPICS = ['Medical Innovations', 'Web Technologies', 'Programming Languages',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['Lecture', 'Workshop', 'Keynote', 'Panel']
+SPEAKERS = 500
+# conferences per organizer
+ORGANIZER_CONFERENCES = 20
+SEED_BATCH_SIZE = 500
+# sold out conferences, for the waitlist, besides the others
+SOLD_OUT = 10
+# calls made by scenarios too slow for CALLS of them, as they read or
+# write the whole seeded catalog
+SCENARIO_CALLS = {
+    'BuildCatalogHandler.get': 3,
+    'BackfillSpeakersHandler.post': 5,
+    'MigrateDurationsHandler.post': 5,
+    'registerForConferences': 10,
+}
+# calls of the reference workload, before and after the scenarios
+REFERENCE_CALLS = 200
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.load_test',
+        description=__doc__.split('\n')[0])
+    parser.add_argument('sdk_path')
+    parser.add_argument('--profiles', type=int, default=500)
+    parser.add_argument('--conferences', type=int, default=1000)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=50,
+                        help='calls per scenario, but those in '
+                             'SCENARIO_CALLS')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed drop of the ratio of ops/s to the '
+                             'reference ops/s, as a fraction of the '
+                             'baseline')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    return parser.parse_args(argv)
+
+
+def seed(options):
+    """Store the profiles, conferences and sessions, with the Speakers and
+    Agendas indexing them, to run against and return what the scenarios
+    need to know about them."""
+    from google.appengine.ext import ndb
+    from agenda import newAgenda
+    from models import Conference
+    from models import Profile
+    from models import Session
+    from models import Speaker
+    from seats import newSeatShards
+    from speakers import speakerKey
+
+    emails = ['user%d@example.com' % i for i in range(options.profiles)]
+    num_organizers = max(1, min(len(emails) // 2,
+                                options.conferences // ORGANIZER_CONFERENCES))
+    organizers, attendees = emails[:num_organizers], emails[num_organizers:]
+    entities = [Profile(id=email, displayName='User %d' % i,
+                        mainEmail=email, teeShirtSize='NOT_SPECIFIED')
+                for i, email in enumerate(emails)]
+
+    start = datetime.date.today() + datetime.timedelta(days=30)
+    conferences = []
+    for i in range(options.conferences):
+        startDate = start + datetime.timedelta(days=i % 365)
+        conf = Conference(
+            key=ndb.Key(Conference, i + 1, parent=ndb.Key(
+                Profile, organizers[i % num_organizers])),
+            name='Conference %05d' % i, description='x' * 200,
+            organizerUserId=organizers[i % num_organizers],
+            topics=[TOPICS[i % len(TOPICS)]], city=CITIES[i % len(CITIES)],
+            startDate=startDate, month=startDate.month,
+            endDate=startDate + datetime.timedelta(days=2),
+            maxAttendees=10 + i % 1000, seatsAvailable=10 + i % 1000)
+        conferences.append(conf)
+        entities.append(conf)
+        entities.extend(newSeatShards(conf, conf.seatsAvailable))
+    sold_out = []
+    for i in range(SOLD_OUT):
+        conf = Conference(
+            key=ndb.Key(Conference, options.conferences + i + 1,
+                        parent=ndb.Key(Profile, organizers[0])),
+            name='Sold out %d' % i, organizerUserId=organizers[0],
+            city=CITIES[0], startDate=start, month=start.month,
+            endDate=start, maxAttendees=100, seatsAvailable=0)
+        sold_out.append(conf)
+        entities.append(conf)
+        entities.extend(newSeatShards(conf, 0))
+
+    sessions = []
+    speakers = {}
+    for i in range(options.sessions):
+        conf = conferences[i % len(conferences)]
+        session = Session(
+            key=ndb.Key(Session, i + 1, parent=conf.key),
+            name='Session %06d' % i, highlights='x' * 200,
+            speaker='Speaker %d' % (i % SPEAKERS), duration='60',
+            durationMinutes=60, endTime=datetime.time(9 + i % 10, 0),
+            typeOfSession=SESSION_TYPES[i % len(SESSION_TYPES)],
+            date=conf.startDate,
+            startTime=datetime.time(8 + i % 10, 0))
+        sessions.append(session)
+        entities.append(session)
+        key = speakerKey(session.speaker)
+        if key not in speakers:
+            speakers[key] = Speaker(key=key, name=session.speaker)
+        speakers[key].sessionKeys.append(session.key)
+    entities.extend(speakers.values())
+    by_conference = {}
+    for session in sessions:
+        by_conference.setdefault(session.key.parent(), []).append(session)
+    for c_key, conf_sessions in by_conference.items():
+        agenda, days = newAgenda(c_key, conf_sessions)
+        entities.append(agenda)
+        entities.extend(days.values())
+
+    for i in range(0, len(entities), SEED_BATCH_SIZE):
+        ndb.put_multi(entities[i:i + SEED_BATCH_SIZE],
+                      use_cache=False, use_memcache=False)
+
+    return {
+        'organizers': organizers,
+        'attendees': attendees,
+        'conferences': [(conf.key.urlsafe(), conf.key.parent().id())
+                        for conf in conferences],
+        'sessions': [session.key.urlsafe() for session in sessions],
+        'soldOut': [conf.key.urlsafe() for conf in sold_out],
+    }
+
+
+def endpointScenarios(fixture, calls):
+    """Return (name, call) pairs driving every ConferenceApi method; call
+    takes the iteration number and makes one request."""
+    import conference as c
+    from conference import ConferenceApi
+    from models import ConferenceForm
+    from models import ConferenceKeysForm
+    from models import ConferenceQueryForm
+    from models import ConferenceQueryForms
+    from models import ProfileMiniForm
+    from models import SessionForm
+    from protorpc.message_types import VoidMessage
+
+    organizers = fixture['organizers']
+    attendees = fixture['attendees']
+    conferences = fixture['conferences']
+    sessions = fixture['sessions']
+    # registering attendees, one per call, and their conferences
+    registering = [(attendees[i % len(attendees)],
+                    conferences[(i * 7) % len(conferences)][0])
+                   for i in range(calls)]
+
+    def api(email):
+        asUser(email)
+        return ConferenceApi()
+
+    def attendee(i):
+        return attendees[i % len(attendees)]
+
+    def organized(i):
+        # a conference and its organizer
+        return conferences[i % len(conferences)]
+
+    def soldOut(i):
+        return fixture['soldOut'][i % len(fixture['soldOut'])]
+
+    def session(i):
+        return sessions[(i * 13) % len(sessions)]
+
+    def createConference(i):
+        api(organizers[i % len(organizers)]).createConference(
+            ConferenceForm(name='Load %d' % i, city='London',
+                           maxAttendees=100, topics=['Web'],
+                           startDate=str(datetime.date.today() +
+                                         datetime.timedelta(days=60))))
+
+    def queryFiltered(i):
+        api(attendee(i)).queryConferences(ConferenceQueryForms(filters=[
+            ConferenceQueryForm(field='MONTH', operator='GT', value='6'),
+            ConferenceQueryForm(field='MAX_ATTENDEES', operator='LT',
+                                value='100')]))
+
+    def createSession(i):
+        wsck, organizer = organized(i)
+        api(organizer).createSession(SessionForm(
+            name='Load session %d' % i, speaker='Speaker %d' % i,
+            typeOfSession='Lecture', date=None, startTime='10:00',
+            duration='30', websafeConferenceKey=wsck))
+
+    def createSessions(i):
+        wsck, organizer = organized(i)
+        api(organizer).createSessions(c.SESSIONS_POST_REQUEST.
+                                      combined_message_class(
+            websafeConferenceKey=wsck,
+            items=[SessionForm(name='Load agenda %d %d' % (i, j),
+                               speaker='Speaker %d' % (j % 5),
+                               typeOfSession='Workshop', startTime='11:00')
+                   for j in range(20)]))
+
+    def registerForConferences(i):
+        api('batch%d@example.com' % i).registerForConferences(
+            ConferenceKeysForm(websafeConferenceKeys=[
+                conferences[(i * 11 + j) % len(conferences)][0]
+                for j in range(10)]))
+
+    return [
+        ('getProfile', lambda i: api(attendee(i)).getProfile(VoidMessage())),
+        ('saveProfile', lambda i: api(attendee(i)).saveProfile(
+            ProfileMiniForm(displayName='User'))),
+        ('createConference', createConference),
+        ('getConference', lambda i: api(attendee(i)).getConference(
+            c.CONF_CONDITIONAL_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=organized(i * 17)[0]))),
+        ('queryConferences', lambda i: api(attendee(i)).queryConferences(
+            ConferenceQueryForms())),
+        ('queryConferences[filtered]', queryFiltered),
+        ('getConferencesCreated',
+         lambda i: api(organizers[i % len(organizers)]).
+         getConferencesCreated(
+             c.FIELDS_GET_REQUEST.combined_message_class())),
+        ('filterPlayground',
+         lambda i: api(attendee(i)).filterPlayground(VoidMessage())),
+        ('registerForConference',
+         lambda i: api(registering[i][0]).registerForConference(
+             c.CONF_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=registering[i][1]))),
+        ('getConferencesToAttend',
+         lambda i: api(registering[i][0]).getConferencesToAttend(
+             VoidMessage())),
+        ('unregisterFromConference',
+         lambda i: api(registering[i][0]).unregisterFromConference(
+             c.CONF_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=registering[i][1]))),
+        ('registerForConferences', registerForConferences),
+        ('joinWaitlist', lambda i: api(attendee(i)).joinWaitlist(
+            c.CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=soldOut(i)))),
+        ('leaveWaitlist', lambda i: api(attendee(i)).leaveWaitlist(
+            c.CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=soldOut(i)))),
+        ('getAnnouncement', lambda i: api(attendee(i)).getAnnouncement(
+            c.ANNOUNCEMENT_GET_REQUEST.combined_message_class())),
+        ('createSession', createSession),
+        ('createSessions', createSessions),
+        ('getConferenceSessions',
+         lambda i: api(attendee(i)).getConferenceSessions(
+             c.SESSION_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=organized(i * 3)[0]))),
+        ('getConferenceSessions[typeOfSession]',
+         lambda i: api(attendee(i)).getConferenceSessions(
+             c.SESSION_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=organized(i * 3)[0],
+                 typeOfSession='Lecture'))),
+        ('searchSessions',
+         lambda i: api(attendee(i)).searchSessions(
+             c.SESSION_SEARCH_REQUEST.combined_message_class(
+                 websafeConferenceKey=organized(i * 3)[0],
+                 startAfter='14:00', maxDuration=60))),
+        ('getConferenceSessionsByType',
+         lambda i: api(attendee(i)).getConferenceSessionsByType(
+             c.SESSION_BYTYPE_GET_REQUEST.combined_message_class(
+                 websafeConferenceKey=organized(i * 3)[0],
+                 typeOfSession='Lecture'))),
+        ('getSessionsBySpeaker',
+         lambda i: api(attendee(i)).getSessionsBySpeaker(
+             c.SESSIONS_BY_SPEAKER_GET_REQUEST.combined_message_class(
+                 speaker='Speaker %d' % (i % SPEAKERS)))),
+        ('addSessionToWishlist',
+         lambda i: api(attendee(i)).addSessionToWishlist(
+             c.WISH_LIST_GET_REQUEST.combined_message_class(
+                 SessionKey=session(i)))),
+        ('getSessionsInWishlist',
+         lambda i: api(attendee(i)).getSessionsInWishlist(VoidMessage())),
+        ('wishlist_by_Type', lambda i: api(attendee(i)).wishlist_by_Type(
+            c.WISH_LIST_BYTYPE_GET_REQUEST.combined_message_class(
+                typeOfSession='Lecture'))),
+        ('wishlist_by_Speaker',
+         lambda i: api(attendee(i)).wishlist_by_Speaker(
+             c.WISH_LIST_BYSPEAKER_GET_REQUEST.combined_message_class(
+                 speaker='Speaker 1'))),
+        ('getWishlistConflicts',
+         lambda i: api(attendee(i)).getWishlistConflicts(VoidMessage())),
+        ('twoIneqFiltersOnDifProp',
+         lambda i: api(attendee(i)).twoIneqFiltersOnDifProp(
+             c.PROBLEM_QUERY_PARAM_GET_REQUEST.combined_message_class(
+                 typeOfSession='Workshop', startTime='12:00',
+                 websafeConferenceKey=organized(i * 3)[0]))),
+        ('getFeaturedSpeaker',
+         lambda i: api(attendee(i)).getFeaturedSpeaker(VoidMessage())),
+    ]
+
+
+def handlerScenarios(fixture):
+    """Return (name, call) pairs driving every main.py handler method."""
+    import webob
+    import main
+
+    conferences = fixture['conferences']
+
+    def request(path, **post):
+        def call(i):
+            params = dict((name, value(i) if callable(value) else value)
+                          for name, value in post.items())
+            response = webob.Request.blank(
+                path, POST=params or None).get_response(main.app)
+            assert response.status_int < 400, (path, response.status)
+        return call
+
+    return [
+        ('SetAnnouncementHandler.get', request('/crons/set_announcement')),
+        ('BuildCatalogHandler.get', request('/crons/build_catalog')),
+        ('CatalogHandler.get', request('/catalog')),
+        ('SendConfirmationEmailsHandler.get',
+         request('/crons/send_confirmation_emails')),
+        ('SendConfirmationEmailHandler.post',
+         request('/tasks/send_confirmation_email',
+                 email='user0@example.com', conferenceInfo='Conference')),
+        ('SyncSeatsAvailableHandler.post',
+         request('/tasks/sync_seats_available', conference_key=lambda i:
+                 conferences[i % len(conferences)][0])),
+        ('Featured_Speaker.post',
+         request('/tasks/featured_speaker', speaker='Speaker 1',
+                 conference_key=lambda i:
+                 conferences[i % len(conferences)][0])),
+        ('AddSpeakerSessionsHandler.post',
+         request('/tasks/add_speaker_sessions', session_keys=lambda i:
+                 fixture['sessions'][i % len(fixture['sessions'])])),
+        ('BackfillSpeakersHandler.get', request('/admin/backfill_speakers')),
+        ('BackfillSpeakersHandler.post',
+         request('/admin/backfill_speakers', cursor='')),
+        ('MigrateDurationsHandler.get', request('/admin/migrate_durations')),
+        ('MigrateDurationsHandler.post',
+         request('/admin/migrate_durations', cursor='')),
+        ('PromoteWaitlistHandler.post',
+         request('/tasks/promote_waitlist', conference_key=lambda i:
+                 conferences[i % len(conferences)][0])),
+        ('SendWaitlistEmailHandler.post',
+         request('/tasks/send_waitlist_email', email='user0@example.com',
+                 conference='Conference')),
+        ('StatsHandler.get', request('/admin/stats')),
+        ('CacheStatsHandler.get', request('/admin/cache_stats')),
+    ]
+
+
+def checkCoverage(names):
+    """Return the endpoint and handler methods no scenario drives."""
+    import main
+    from conference import ConferenceApi
+
+    covered = set(name.split('[')[0] for name in names)
+    expected = set(ConferenceApi.all_remote_methods())
+    for route in main.app.router.match_routes:
+        expected.update('%s.%s' % (route.handler.__name__, method)
+                        for method in ('get', 'post')
+                        if method in vars(route.handler))
+    return sorted(expected - covered)
+
+
+class RpcCounter(object):
+    """RpcCounter -- counts datastore RPCs through an apiproxy hook"""
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map
+        self.count = 0
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'load_test', self.hook)
+
+    def hook(self, service, call, request, response):
+        if service == 'datastore_v3':
+            self.count += 1
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def referenceCall(fixture):
+    """Return the call of the reference workload: a batched get of a few
+    seeded conferences and their organizers' profiles."""
+    from google.appengine.ext import ndb
+
+    keys = [ndb.Key(urlsafe=wsck) for wsck, organizer
+            in fixture['conferences'][:10]]
+    keys += [key.parent() for key in keys]
+
+    def call(i):
+        ndb.get_multi(keys)
+    return call
+
+
+def measure(call, calls, counter):
+    """Make calls requests with call, returning their ops/s, latency
+    percentiles and datastore RPCs per call."""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+
+    latencies = []
+    rpcs = 0
+    for i in range(calls):
+        # each call is a new request, with a new ndb context cache, and
+        # finds memcache empty, so RPCs are not hidden by earlier calls
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        call_rpcs = counter.count
+        call_started = time.time()
+        call(i)
+        latencies.append((time.time() - call_started) * 1000)
+        rpcs += counter.count - call_rpcs
+    latencies.sort()
+    return {
+        'opsPerSec': round(calls / (sum(latencies) / 1000), 2),
+        'p50Ms': round(percentile(latencies, 50), 2),
+        'p95Ms': round(percentile(latencies, 95), 2),
+        'p99Ms': round(percentile(latencies, 99), 2),
+        'rpcsPerCall': round(float(rpcs) / calls, 2),
+    }
+
+
+def run(scenarios, reference, calls, counter):
+    """Make calls requests per scenario, fewer for those in
+    SCENARIO_CALLS, returning results by name, and the ops/s of the
+    reference workload, measured before and after them to even out
+    drift."""
+    before = measure(reference, REFERENCE_CALLS, counter)['opsPerSec']
+    results = {}
+    for name, call in scenarios:
+        scenario_calls = min(calls, SCENARIO_CALLS.get(name, calls))
+        results[name] = measure(call, scenario_calls, counter)
+        results[name]['calls'] = scenario_calls
+    after = measure(reference, REFERENCE_CALLS, counter)['opsPerSec']
+    reference_ops = (before + after) / 2
+    for result in results.values():
+        # enough digits that the slowest scenarios do not round to zero
+        result['relativeOps'] = round(
+            result['opsPerSec'] / reference_ops, 6)
+    return results, reference_ops
+
+
+def printResults(names, results):
+    print '%-36s %9s %8s %8s %8s %8s %8s' % (
+        'method', 'ops/s', 'vs ref', 'p50 ms', 'p95 ms', 'p99 ms', 'rpcs')
+    for name in names:
+        r = results[name]
+        print '%-36s %9.2f %8.4f %8.2f %8.2f %8.2f %8.2f' % (
+            name, r['opsPerSec'], r['relativeOps'], r['p50Ms'], r['p95Ms'],
+            r['p99Ms'], r['rpcsPerCall'])
+
+
+def regressions(results, baseline, tolerance):
+    """Return a description of each result worse than its baseline: ops/s
+    relative to the reference lower by more than tolerance, or more
+    datastore RPCs per call."""
+    found = []
+    for name, base in sorted(baseline.items()):
+        result = results.get(name)
+        if result is None:
+            found.append('%s: no longer measured' % name)
+            continue
+        if result['relativeOps'] < base['relativeOps'] * (1 - tolerance):
+            found.append('%s: %.6f of reference ops/s, baseline %.6f' % (
+                name, result['relativeOps'], base['relativeOps']))
+        # RPC counts hardly vary between runs; allow for random shard picks
+        if result['rpcsPerCall'] > base['rpcsPerCall'] * 1.1 + 0.5:
+            found.append('%s: %.2f datastore RPCs per call, baseline %.2f' % (
+                name, result['rpcsPerCall'], base['rpcsPerCall']))
+    return found
+
+
+def main(argv):
+    options = parseArgs(argv)
+    setupSdk(options.sdk_path)
+    bed = activateStubs()
+    random.seed(0)
+
+    started = time.time()
+    fixture = seed(options)
+    print 'seeded %d profiles, %d conferences, %d sessions in %.1fs' % (
+        options.profiles, options.conferences, options.sessions,
+        time.time() - started)
+
+    scenarios = (endpointScenarios(fixture, options.calls) +
+                 handlerScenarios(fixture))
+    names = [name for name, call in scenarios]
+    missing = checkCoverage(names)
+    if missing:
+        print 'no scenario for: %s' % ', '.join(missing)
+        return 1
+
+    results, reference_ops = run(scenarios, referenceCall(fixture),
+                                 options.calls, RpcCounter())
+    bed.deactivate()
+    printResults(names, results)
+    print 'reference workload: %.1f ops/s' % reference_ops
+
+    volumes = {'profiles': options.profiles,
+               'conferences': options.conferences,
+               'sessions': options.sessions, 'calls': options.calls}
+    if options.update_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump({'volumes': volumes, 'referenceOps': reference_ops,
+                       'results': results}, f, indent=1, sort_keys=True)
+        print 'baseline written to %s' % options.baseline
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print 'no baseline at %s' % options.baseline
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline['volumes'] != volumes:
+        print 'baseline is for %s; not compared' % baseline['volumes']
+        return 0
+    if 'referenceOps' not in baseline:
+        print 'baseline has no reference ops/s; not compared'
+        return 0
+    found = regressions(results, baseline['results'], options.tolerance)
+    for regression in found:
+        print 'REGRESSION %s' % regression
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+""" Two-level read-through cache: in-instance LRU in front of memcache"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+MEMCACHE_CACHE_STATS_KEY = "CACHE STATS %s %s"
+# how often each instance adds its hit/miss counts to the memcache totals
+STATS_FLUSH_INTERVAL = 60
+STATS_COUNTERS = ('localHits', 'localMisses', 'memcacheHits',
+                  'memcacheMisses')
+
+
+class LocalCache(object):
+    """LocalCache -- size bounded, in-instance LRU cache with a TTL"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        """Cache value for key, evicting the least recently used entry."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop key from the cache."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class TwoLevelCache(object):
+    """TwoLevelCache -- read-through cache over LocalCache and memcache
+
+    Values are kept as is in the instance cache and through encode/decode
+    in memcache, under the version of the key the caller read before
+    loading them. Writers start a new version after writing, so a value
+    loaded from data older than a write is only ever cached under a
+    version no longer read, and needs no invalidation."""
+
+    def __init__(self, name, encode, decode, max_size=1000, local_ttl=10,
+                 memcache_ttl=600):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.memcache_ttl = memcache_ttl
+        self.local = LocalCache(max_size, local_ttl)
+        self._counts = dict.fromkeys(STATS_COUNTERS, 0)
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+
+    def _memcacheKey(self, key, version):
+        return '%s %s %s' % (self.name, key, version)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counts[counter] += 1
+            if time.time() - self._flushed < STATS_FLUSH_INTERVAL:
+                return
+            counts = self._counts
+            self._counts = dict.fromkeys(STATS_COUNTERS, 0)
+            self._flushed = time.time()
+        memcache.offset_multi(
+            {MEMCACHE_CACHE_STATS_KEY % (self.name, counter): count
+             for counter, count in counts.items() if count},
+            initial_value=0)
+
+    def get(self, key, version, loader):
+        """Return the value for key at version, calling loader() on a miss
+        at both levels. None results from loader are not cached."""
+        cached = self.local.get(key)
+        if cached is not None and cached[0] == version:
+            self._count('localHits')
+            return cached[1]
+        self._count('localMisses')
+
+        mc_key = self._memcacheKey(key, version)
+        encoded = memcache.get(mc_key)
+        if encoded is not None:
+            self._count('memcacheHits')
+            value = self.decode(encoded)
+        else:
+            self._count('memcacheMisses')
+            value = loader()
+            if value is None:
+                return None
+            memcache.set(mc_key, self.encode(value), time=self.memcache_ttl)
+        self.local.set(key, (version, value))
+        return value
+
+    def stats(self):
+        """Return the hit/miss totals flushed to memcache by all
+        instances, plus the counts this instance has not flushed yet."""
+        totals = memcache.get_multi(
+            [MEMCACHE_CACHE_STATS_KEY % (self.name, counter)
+             for counter in STATS_COUNTERS])
+        with self._lock:
+            return {counter: self._counts[counter] + int(totals.get(
+                MEMCACHE_CACHE_STATS_KEY % (self.name, counter), 0))
+                for counter in STATS_COUNTERS}
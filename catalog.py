@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+""" Materialized catalog of upcoming conferences
+
+A cron job renders every upcoming conference as the JSON ConferenceForms
+that queryConferences would return, gzips it and stores it in chunks
+with a hash of its content. Unfiltered listings are served from that
+snapshot with ETag revalidation instead of querying and serializing the
+catalog."""
+
+import gzip
+import hashlib
+import StringIO
+from datetime import date
+
+from protorpc import protojson
+
+from google.appengine.ext import ndb
+
+from cache import LocalCache
+from conference import ConferenceApi
+from models import CatalogChunk
+from models import CatalogSnapshot
+from models import Conference
+from models import ConferenceForms
+
+CATALOG_KEY = ndb.Key(CatalogSnapshot, 'upcoming')
+# seconds browsers and proxies may reuse the catalog without revalidating
+CATALOG_MAX_AGE = 60
+# bytes of gzipped JSON per CatalogChunk, well below the 1MB an entity
+# or a memcache value may hold
+CATALOG_CHUNK_SIZE = 500000
+# the (etag, data) read per instance; ndb keeps the entities in memcache
+# too
+_local = LocalCache(max_size=1, ttl=10)
+
+
+def _gzip(data):
+    out = StringIO.StringIO()
+    # a fixed mtime so the same catalog always compresses the same
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _chunkKeys(etag, count):
+    return [ndb.Key(CatalogChunk, '%s %d' % (etag, i), parent=CATALOG_KEY)
+            for i in range(count)]
+
+
+def buildCatalog():
+    """Store a new snapshot of the upcoming conferences if the catalog
+    changed, returning the current (etag, gzipped data)."""
+    today = date.today()
+    conferences = [conf for conf in Conference.query().order(Conference.name)
+                   if not conf.startDate or conf.startDate >= today]
+    forms = ConferenceApi()._conferenceFormsAsync(conferences).get_result()
+    data = protojson.encode_message(ConferenceForms(items=forms))
+    etag = hashlib.sha1(data).hexdigest()
+    data = _gzip(data)
+
+    snapshot = CATALOG_KEY.get()
+    # snapshots stored whole, before chunks, have no chunk count
+    if not snapshot or snapshot.etag != etag or snapshot.chunks is None:
+        parts = [data[i:i + CATALOG_CHUNK_SIZE]
+                 for i in range(0, len(data), CATALOG_CHUNK_SIZE)]
+        # the chunks first, so the snapshot never names missing ones
+        ndb.put_multi([CatalogChunk(key=key, data=part) for key, part in
+                       zip(_chunkKeys(etag, len(parts)), parts)])
+        previous = snapshot and snapshot.etag
+        CatalogSnapshot(key=CATALOG_KEY, etag=etag, chunks=len(parts)).put()
+        # keep the previous version's chunks for instances still reading
+        # it, and drop older ones
+        ndb.delete_multi(
+            [key for key in CatalogChunk.query(ancestor=CATALOG_KEY).iter(
+                keys_only=True)
+             if key.id().split(' ')[0] not in (etag, previous)])
+    _local.set(CATALOG_KEY, (etag, data))
+    return etag, data
+
+
+def getCatalog():
+    """Return the current catalog (etag, gzipped data), building the
+    first snapshot if there is none yet."""
+    catalog = _local.get(CATALOG_KEY)
+    if catalog is None:
+        snapshot = CATALOG_KEY.get()
+        parts = (ndb.get_multi(_chunkKeys(snapshot.etag, snapshot.chunks))
+                 if snapshot and snapshot.chunks is not None else [None])
+        if None in parts:
+            catalog = buildCatalog()
+        else:
+            catalog = (snapshot.etag, ''.join(part.data for part in parts))
+        _local.set(CATALOG_KEY, catalog)
+    return catalog
+
+
+def gunzip(data):
+    """Return the uncompressed catalog data, for clients that do not
+    accept gzip."""
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
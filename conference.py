@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 
+import hashlib
+import logging
+import random
 from datetime import datetime
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 from models import Profile
 from models import ProfileMiniForm
@@ -20,20 +27,87 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceKeysForm
+from models import RegistrationResult
+from models import RegistrationResults
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SpeakerIndex
+from models import WishlistConflictForm
+from models import WishlistConflictForms
+from models import WishlistEntry
 from models import BooleanMessage
 from models import ConflictException
+from models import NearlySoldOut
 from models import StringMessage
 
+from agenda import addSessions
+from agenda import agendaDayKeys
+from agenda import agendaKey
+from agenda import agendaSessions
+from agenda import getAgenda
+from agenda import newAgenda
+
+from cache import TwoLevelCache
+
+from emails import enqueueConfirmation
+
+from serializers import CONFERENCE_PLAN
+from serializers import PROFILE_PLAN
+from serializers import SESSION_PLAN
+
+from seats import NEARLY_SOLD_OUT_SEATS
+from seats import ensureSeatShards
+from seats import addSeatShard
+from seats import countSeatsAvailable
+from seats import getSeatsAvailable
+from seats import getSeatsAvailableMultiAsync
+from seats import newSeatShards
+from seats import seatShardKeys
+from seats import seatsChanged
+
+from schedule import endTime
+from schedule import findConflicts
+from schedule import formatMinutes
+from schedule import parseDuration
+from schedule import sessionInterval
+
+from search import MATCHERS
+from search import invalidateSearches
+from search import searchConferences
+
+from versions import bumpVersions
+from versions import conferenceVersion
+from versions import getVersion
+from versions import requestTag
+from versions import sessionsVersion
+
+from speakers import getSpeakerSessions
+from speakers import speakerKey
+
+from stats import instrumented
+
+from waitlist import addWaiter
+from waitlist import hasWaitersAsync
+from waitlist import promoteWaiters
+from waitlist import removeWaiter
+
 from settings import WEB_CLIENT_ID
 from utils import getUserId
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT ANNOUNCEMENTS"
+# (NearlySoldOut version, announcement)
+MEMCACHE_ANNOUNCEMENTS_KEY = "NEARLY SOLD OUT ANNOUNCEMENT"
 MEMCACHE_FEATURED_SPEAKER = "FEATURED SPEAKER FOR THIS CONFERENCE"
+MEMCACHE_DISPLAY_NAME_KEY = "DISPLAY NAME %s"
+NEARLY_SOLD_OUT_KEY = ndb.Key(NearlySoldOut, 'announcement')
+
+# rendered ConferenceForm per websafe conference key, see getConference
+CONFERENCE_FORM_CACHE = TwoLevelCache(
+    "CONFERENCE FORM", protojson.encode_message,
+    lambda encoded: protojson.decode_message(ConferenceForm, encoded))
 
 DEFAULTS = {
     "city": "Default City",
@@ -51,6 +125,42 @@ OPERATORS = {
             'NE': '!='
 }
 
+# page size used when the client does not ask for one, and the hard
+# server-side cap on any single page
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Projections of list queries, used when they hold every field a client
+# asks for. Unfiltered conference listings are ordered by name, whose
+# built-in index can project it; name is required, so no conference is
+# left out.
+CONFERENCE_NAME_PROJECTION = ['name']
+# served by the (startTime, typeOfSession) index
+PROBLEM_QUERY_PROJECTION = ['startTime', 'typeOfSession']
+
+# registration is refused while a conference has a waitlist
+WAITLIST_FIRST = ("Others are waiting for a seat at this conference; join "
+                  "its waitlist to be registered in turn.")
+
+# speakers name their SpeakerIndex and Speaker keys, and key names are
+# limited to 500 bytes
+MAX_SPEAKER_BYTES = 500
+
+# entity groups a cross group transaction may touch
+MAX_XG_ENTITY_GROUPS = 25
+
+# searchSessions counts the sessions matching each filter up to this many
+# to pick the one to run in the datastore
+SESSION_COUNT_LIMIT = 1000
+
+# sessions written per transaction by createSessions; with their speaker
+# indexes and agenda days this stays under the 500 entities a commit may
+# write
+SESSION_PUT_BATCH_SIZE = 150
+
+# WishlistEntries written per put_multi when migrating a legacy wishlist
+WISHLIST_MIGRATION_BATCH_SIZE = 500
+
 FIELDS = {
     'CITY': 'city',
             'TOPIC': 'topics',
@@ -64,21 +174,51 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+# ifNoneMatch is the etag of the client's copy, if any
+CONF_CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+
+FIELDS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+)
+
 
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
+    ifNoneMatch=messages.StringField(5),
+    typeOfSession=messages.StringField(6),
+)
+
+SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
 )
 
 SESSION_BYTYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True),
 )
 
 SESSIONS_BY_SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
 )
 
 WISH_LIST_GET_REQUEST = endpoints.ResourceContainer(
@@ -97,10 +237,27 @@ WISH_LIST_BYSPEAKER_GET_REQUEST = endpoints.ResourceContainer(
 )
 
 
+# times in 24 hour notation, durations in minutes
+SESSION_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    startAfter=messages.StringField(2),
+    endBefore=messages.StringField(3),
+    maxDuration=messages.IntegerField(4),
+    typeOfSession=messages.StringField(5),
+    pageSize=messages.IntegerField(6),
+    pageToken=messages.StringField(7),
+    fields=messages.StringField(8, repeated=True),
+)
+
 PROBLEM_QUERY_PARAM_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     typeOfSession=messages.StringField(1),
     startTime=messages.StringField(2),
+    websafeConferenceKey=messages.StringField(3),
+    pageSize=messages.IntegerField(4),
+    pageToken=messages.StringField(5),
+    fields=messages.StringField(6, repeated=True),
 )
 
 
@@ -118,43 +275,42 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(
-                        pf, field.name, getattr(
-                            TeeShirtSize, getattr(
-                                prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return PROFILE_PLAN.copy(prof)
 
     def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if
-        non-existent."""
+        """Return user Profile from datastore, or a new unsaved one if
+        non-existent. The new Profile is stored by the first write to it."""
+        return self._getProfileFromUserAsync().get_result()
+
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
+        """Tasklet version of _getProfileFromUser()."""
+        # a new service object is created for each request, so this
+        # remembers the profile for the rest of the request
+        profile = getattr(self, '_profile', None)
+        if profile:
+            raise ndb.Return(profile)
+
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        # get the entity from datastore by using get() on the key
-        profile = p_key.get()
+        # get the entity from ndb's caches or datastore by using get() on
+        # the key
+        profile = yield p_key.get_async()
         if not profile:
-            profile = Profile(
-                key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
-                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            # save the profile to datastore
-            profile.put()
+            # not saved to datastore until something changes in it
+            profile = Profile(key=p_key, **self._newProfileValues(user))
 
-        return profile      # return Profile
+        self._profile = profile
+        raise ndb.Return(profile)      # return Profile
+
+    def _newProfileValues(self, user):
+        """Return the property values of a new Profile of user."""
+        return dict(displayName=user.nickname(), mainEmail=user.email(),
+                    teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED))
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
@@ -163,6 +319,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -171,18 +328,27 @@ class ConferenceApi(remote.Service):
             # TODO 4
             # put the modified profile to datastore
             prof.put()
+            # cached forms of this user's conferences show the old name
+            if prof.displayName != displayName:
+                memcache.set(MEMCACHE_DISPLAY_NAME_KEY % prof.key.id(),
+                             prof.displayName)
+                self._conferencesChanged(
+                    *[c_key.urlsafe() for c_key in Conference.query(
+                        ancestor=prof.key).fetch(keys_only=True)])
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -190,23 +356,112 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        if seatsAvailable is None:
+            seatsAvailable = getSeatsAvailable(conf)
+        cf = CONFERENCE_PLAN.copy(conf)
+        # the stored seatsAvailable is only a snapshot of the seat shards
+        cf.seatsAvailable = seatsAvailable
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+            cf.organizerDisplayName = displayName
         return cf
 
+    @ndb.tasklet
+    def _getWithParentAsync(self, key):
+        """Fetch an entity and its parent entity concurrently."""
+        entity, parent = yield key.get_async(), key.parent().get_async()
+        raise ndb.Return((entity, parent))
+
+    @ndb.tasklet
+    def _getOrganizerNamesAsync(self, conf_keys):
+        """Return a dict of organizer userId to displayName for the given
+        conference keys, from memcache or one batched get of their
+        Profiles."""
+        ctx = ndb.get_context()
+        user_ids = list(set(c_key.parent().id() for c_key in conf_keys))
+        # the context batches these into a single memcache RPC
+        values = yield [ctx.memcache_get(MEMCACHE_DISPLAY_NAME_KEY % user_id)
+                        for user_id in user_ids]
+        names = {user_id: name for user_id, name in zip(user_ids, values)
+                 if name is not None}
+
+        missing = [ndb.Key(Profile, user_id)
+                   for user_id in user_ids if user_id not in names]
+        profiles = yield ndb.get_multi_async(missing)
+        fetched = {}
+        for profile in profiles:
+            if profile:
+                fetched[profile.key.id()] = profile.displayName
+        yield [ctx.memcache_set(MEMCACHE_DISPLAY_NAME_KEY % user_id, name)
+               for user_id, name in fetched.items()]
+        names.update(fetched)
+        raise ndb.Return(names)
+
+    @ndb.tasklet
+    def _getConferencesWithOrganizersAsync(self, conf_keys):
+        """Fetch conferences by key together with their organizers'
+        display names, as a (conferences, names) pair."""
+        # organizer keys are the parents of the conference keys, so both
+        # can be fetched at once
+        conferences, names = yield (ndb.get_multi_async(conf_keys),
+                                    self._getOrganizerNamesAsync(conf_keys))
+        raise ndb.Return((conferences, names))
+
+    @ndb.tasklet
+    def _conferenceFormsAsync(self, conferences, names=None, fields=None):
+        """Return ConferenceForms items for conferences, looking up
+        organizer names (unless given) and seat counts concurrently.
+        fields, if given, are the only message fields filled in."""
+        want_names = not fields or 'organizerDisplayName' in fields
+        want_seats = not fields or 'seatsAvailable' in fields
+        if names is None and want_names:
+            names = self._getOrganizerNamesAsync(
+                [conf.key for conf in conferences])
+        seats = []
+        if want_seats:
+            seats = yield getSeatsAvailableMultiAsync(conferences)
+        if isinstance(names, ndb.Future):
+            names = yield names
+
+        plan = CONFERENCE_PLAN.masked(fields) if fields else CONFERENCE_PLAN
+        forms = plan.copyMulti(conferences)
+        for i, (cf, conf) in enumerate(zip(forms, conferences)):
+            if want_seats:
+                cf.seatsAvailable = seats[i]
+            if want_names:
+                displayName = names.get(conf.key.parent().id())
+                if displayName:
+                    cf.organizerDisplayName = displayName
+        raise ndb.Return(forms)
+
+    def _fieldMask(self, message_class, fields):
+        """Check the message field names a client asked for, returning
+        them as a set, or None if all fields are wanted."""
+        if not fields:
+            return None
+        unknown = set(fields) - set(
+            field.name for field in message_class.all_fields())
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields: %s' % ', '.join(sorted(unknown)))
+        return set(fields)
+
+    def _projection(self, model_class, fields, projectable):
+        """Return the properties of model_class to project to fill in the
+        message fields, or None if whole entities are needed.
+
+        projectable names the properties an index of the query can
+        project, and that every stored entity has: a projection leaves
+        out entities without one of its properties."""
+        if not fields:
+            return None
+        projection = sorted(name for name in fields
+                            if name in model_class._properties)
+        if not projection or not set(projection) <= set(projectable):
+            return None
+        return projection
+
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning
         ConferenceForm/request."""
@@ -225,6 +480,8 @@ class ConferenceApi(remote.Service):
                 for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound
         # Message)
@@ -260,56 +517,105 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        # create Conference and its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified)
+        # ConferenceForm
+        conf = Conference(**data)
+        ndb.put_multi([conf] + newSeatShards(conf, data['seatsAvailable']))
+        # listings name the organizer from their Profile, so store it if
+        # they have not saved one yet
+        Profile.get_or_insert(user_id, **self._newProfileValues(user))
+        invalidateSearches()
+        if 0 < data['seatsAvailable'] <= NEARLY_SOLD_OUT_SEATS:
+            taskqueue.add(params={'conference_key': c_key.urlsafe()},
+                          url='/tasks/sync_seats_available')
+        enqueueConfirmation(user.email(), conf)
 
         return request
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
+    @staticmethod
+    def _conferencesChanged(*wscks):
+        """Start new versions of the given conferences, which their cached
+        forms are kept under."""
+        bumpVersions(*[conferenceVersion(wsck) for wsck in wscks])
+
     # Get the conferences so that we can register them.
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        """Return requested conference (by websafeConferenceKey), or just
+        notModified if its etag is ifNoneMatch."""
+        wsck = request.websafeConferenceKey
+        # read the version first, so the form is at least as new as it
+        etag = getVersion(conferenceVersion(wsck))
+        if request.ifNoneMatch == etag:
+            return ConferenceForm(etag=etag, notModified=True)
+        cf = CONFERENCE_FORM_CACHE.get(
+            wsck, etag,
+            lambda: self._loadConferenceFormAsync(wsck).get_result())
+        # the cached form is shared by requests, so tag a copy of it
+        tagged = ConferenceForm()
+        for field in cf.all_fields():
+            value = cf.get_assigned_value(field.name)
+            if value is not None:
+                setattr(tagged, field.name, value)
+        tagged.etag = etag
+        return tagged
+
+    @ndb.tasklet
+    def _loadConferenceFormAsync(self, wsck):
+        """Return ConferenceForm for a websafe conference key from the
+        datastore."""
+        # get Conference object and its organizer; bail if not found
+        conf, prof = yield self._getWithParentAsync(ndb.Key(urlsafe=wsck))
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' %
-                request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        seats = yield getSeatsAvailableMultiAsync([conf])
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(
+            conf, getattr(prof, 'displayName', None), seats[0])
+        raise ndb.Return(cf)
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
         """Query for conferences."""
-        # conferences = Conference.query()
-        conferences = self._getQuery(request)
+        filters = self._formatFilters(request.filters)
+        fields = self._fieldMask(ConferenceForm, request.fields)
+        if filters:
+            conferences, next_token = self._searchPage(
+                filters, request.pageSize, request.pageToken)
+        else:
+            q = Conference.query().order(Conference.name)
+            conferences, next_token = self._fetchPage(
+                q, request.pageSize, request.pageToken,
+                projection=self._projection(
+                    Conference, fields, CONFERENCE_NAME_PROJECTION))
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "")
-                   for conf in conferences]
+            items=self._conferenceFormsAsync(
+                conferences, fields=fields).get_result(),
+            nextPageToken=next_token
         )
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(FIELDS_GET_REQUEST, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -319,68 +625,45 @@ class ConferenceApi(remote.Service):
 
         # make profile key
         p_key = ndb.Key(Profile, getUserId(user))
-        # create ancestor query for this user
-        conferences = Conference.query(ancestor=p_key)
-        # get the user profile and display name
-        prof = p_key.get()
-        displayName = getattr(prof, 'displayName')
+        fields = self._fieldMask(ConferenceForm, request.fields)
+        # run ancestor query for this user and get the user profile
+        # concurrently
+        prof = self._getProfileFromUserAsync()
+        conferences = Conference.query(ancestor=p_key).fetch()
+        # get the display name
+        displayName = getattr(prof.get_result(), 'displayName')
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[
-                self._copyConferenceToForm(
-                    conf,
-                    displayName) for conf in conferences])
+            items=self._conferenceFormsAsync(
+                conferences, {p_key.id(): displayName},
+                fields).get_result())
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground',
                       http_method='GET', name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
-        q = Conference.query()
-        # Simple filter usage:
-
-        # 1. City equals London
-
-        q = q.filter(Conference.city == "London")
-
-        # 2. Topic equals medical innovation
-        q = q.filter(Conference.topics == "Medical Innovations")
-
-        # 3. Order by conference name:
-        q = q.order(Conference.name)
-
-        # 4. All Conferences in specific Month (October)
-
-        # q = q.filter(Conference.month == 10)
-        q = q.filter(Conference.maxAttendees > 10)
-
+        # Conferences in London on medical innovation with more than 10
+        # attendees, ordered by conference name
+        filters = [
+            {'field': 'city', 'operator': '=', 'value': 'London'},
+            {'field': 'topics', 'operator': '=',
+             'value': 'Medical Innovations'},
+            {'field': 'maxAttendees', 'operator': '>', 'value': 10},
+            # {'field': 'month', 'operator': '<', 'value': 10},
+        ]
+
+        conferences = ndb.get_multi(searchConferences(filters)[0])
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=self._conferenceFormsAsync(conferences).get_result()
         )
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(
-                filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
-
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters.
+
+        Any number of inequality filters, on any fields, may be combined;
+        see search.py."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name)
@@ -393,98 +676,404 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # Check if inequality operation has been used in previous
-                # filters.
-                # Disallow the filter if inequality was performed on a
-                # different field before.
-                # Track the field on which the inequality operation is
-                # performed.
-                if inequality_field and inequality_field != filtr["field"]:
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
                     raise endpoints.BadRequestException(
-                        "Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+                        "Filter on %s needs a number." % filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
+
+    def _pageSize(self, page_size):
+        """Return the page size to use for a client supplied one."""
+        if not page_size or page_size < 0:
+            page_size = DEFAULT_PAGE_SIZE
+        return min(page_size, MAX_PAGE_SIZE)
+
+    def _pageOffset(self, page_token):
+        """Return the offset a page token made by str(offset) stands for,
+        0 if there is none."""
+        if not page_token:
+            return 0
+        try:
+            offset = int(page_token)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException(
+                'Invalid page token: %s' % page_token)
+        return offset
+
+    def _searchPage(self, filters, page_size, page_token):
+        """Fetch one page of conferences matching filters, returning
+        (conferences, token).
+
+        The token is the offset of the next page in the search results,
+        or None when there are no more results."""
+        page_size = self._pageSize(page_size)
+        offset = self._pageOffset(page_token)
+        keys, total = searchConferences(filters, offset, page_size)
+        conferences = ndb.get_multi(keys)
+        next_token = None
+        if offset + page_size < total:
+            next_token = str(offset + page_size)
+        # skip conferences deleted since the search results were cached
+        return [conf for conf in conferences if conf], next_token
+
+    def _fetchPage(self, query, page_size, page_token, keep=None,
+                   **q_options):
+        """Fetch one page of query results, returning (results, token).
+
+        The token is an opaque datastore cursor for the next page, or None
+        when there are no more results. If keep is given, results it
+        returns False for are skipped and the page is filled from the
+        results after them. q_options are passed on to the query."""
+        page_size = self._pageSize(page_size)
+
+        # a token may decode as a cursor yet not be a valid one, which
+        # only the fetch finds out
+        try:
+            cursor = ndb.Cursor(urlsafe=page_token) if page_token else None
+            if keep is None:
+                results, next_cursor, more = query.fetch_page(
+                    page_size, start_cursor=cursor, **q_options)
+            else:
+                # read one kept result past the page, so the next page
+                # starts at it and is never empty
+                results, more, next_cursor = [], False, None
+                it = query.iter(start_cursor=cursor, produce_cursors=True,
+                                **q_options)
+                for result in it:
+                    if not keep(result):
+                        continue
+                    if len(results) == page_size:
+                        more, next_cursor = True, it.cursor_before()
+                        break
+                    results.append(result)
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException(
+                'Invalid page token: %s' % page_token)
+        next_token = None
+        if more and next_cursor:
+            next_token = next_cursor.urlsafe()
+        return results, next_token
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     # (xg = True) means cross group or two different entity groups.
-    # Each profile can register for conferences created by other profiles
-    @ndb.transactional(xg=True)
+    # Each registration touches the user's Profile and a single seat shard
+    # per conference, never the Conference itself, so a popular conference
+    # does not serialize its registrations on one entity group. A cross
+    # group transaction may touch at most 25 entity groups.
+    @ndb.transactional_tasklet(xg=True)
+    def _updateRegistration(self, profile, picks, reg):
+        """Move one seat between a seat shard and a user Profile for each
+        picked conference.
+
+        picks is a list of (websafe conference key, shard key) pairs.
+        Returns (moved, unchanged) websafe keys: those moved, and those
+        the user is registered for already when registering, or not
+        registered for when unregistering. The other picked shards had
+        no seat to give."""
+        entities = yield ndb.get_multi_async(
+            [profile.key] + [shard_key for wsck, shard_key in picks])
+        prof = entities[0]
+        # first write for a new user; copy so a retry starts clean
+        if not prof:
+            prof = Profile(key=profile.key, **profile.to_dict())
+
+        moved, unchanged = [], []
+        shards = []
+        for (wsck, shard_key), shard in zip(picks, entities[1:]):
+            # register
+            if reg:
+                # check if user already registered otherwise add
+                if wsck in prof.conferenceKeysToAttend:
+                    unchanged.append(wsck)
+                    continue
+
+                # check if seats avail in this shard
+                if shard.seatsAvailable <= 0:
+                    continue
+
+                # register user, take away one seat
+                prof.conferenceKeysToAttend.append(wsck)
+                shard.seatsAvailable -= 1
+
+            # unregister
+            else:
+                # check if user already registered
+                if wsck not in prof.conferenceKeysToAttend:
+                    unchanged.append(wsck)
+                    continue
+
+                # unregister user, add back one seat and offer it to the
+                # waitlist
+                prof.conferenceKeysToAttend.remove(wsck)
+                shard.seatsAvailable += 1
+                taskqueue.add(params={'conference_key': wsck},
+                              url='/tasks/promote_waitlist',
+                              transactional=True)
+            shards.append(shard)
+            moved.append(wsck)
+
+        # write things back to the datastore & return
+        if moved:
+            yield ndb.put_multi_async([prof] + shards)
+        raise ndb.Return((moved, unchanged))
+
+    @staticmethod
+    def _seatsChanged(changes):
+        """Record seat count changes of conferences, a list of
+        (Conference, delta) pairs, in their cached forms and memcached
+        sums, and queue syncing their stored counts."""
+        confs = [conf for conf, delta in changes]
+        ConferenceApi._conferencesChanged(
+            *[conf.key.urlsafe() for conf in confs])
+        seatsChanged(confs, [delta for conf, delta in changes])
+
+    @ndb.tasklet
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser()  # get user Profile
-
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        # get user Profile and conference given websafeConfKey
+        # concurrently; check that conference exists
         wsck = request.websafeConferenceKey
-        print "This is wsck: %s" % wsck
-        print "This is wsck type: %s" % type(wsck)
-
-        conf = ndb.Key(urlsafe=wsck).get()
+        c_key = ndb.Key(urlsafe=wsck)
+        waiting = hasWaitersAsync(c_key) if reg else None
+        prof, conf = yield (self._getProfileFromUserAsync(),
+                            c_key.get_async())
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        conf = ensureSeatShards(conf)
+        shard_keys = seatShardKeys(conf)
 
-        # register
         if reg:
-            # check if user already registered otherwise add
             if wsck in prof.conferenceKeysToAttend:
                 raise ConflictException(
                     "You have already registered for this conference")
-
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
-
-        # unregister
+            # seats given back go to those waiting, in turn
+            if (yield waiting):
+                raise ConflictException(WAITLIST_FIRST)
+            # try the shards that still have seats, in random order so
+            # concurrent registrations spread across them
+            shards = yield ndb.get_multi_async(shard_keys)
+            shard_keys = [shard.key for shard in shards
+                          if shard and shard.seatsAvailable > 0]
+            random.shuffle(shard_keys)
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            # any shard can take a seat back
+            shard_keys = [random.choice(shard_keys)]
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
-
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        retval = False
+        contended = None
+        for shard_key in shard_keys:
+            try:
+                moved, unchanged = yield self._updateRegistration(
+                    prof, [(wsck, shard_key)], reg)
+            except datastore_errors.TransactionFailedError as e:
+                # other registrations hold this shard; try the next one
+                contended = e
+                continue
+            if reg and unchanged:
+                raise ConflictException(
+                    "You have already registered for this conference")
+            retval = bool(moved)
+            if moved or unchanged:
+                break
+        if contended:
+            addSeatShard(c_key)
+            if not retval:
+                raise contended
+
+        if reg and not retval:
+            raise ConflictException(
+                "There are no seats available; join the waitlist to be "
+                "registered when one is given back.")
+
+        if retval:
+            # the transaction wrote its own copy of the profile
+            self._profile = None
+            self._seatsChanged([(conf, -1 if reg else 1)])
+        raise ndb.Return(BooleanMessage(data=retval))
 
     # Register for conference:
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        return self._conferenceRegistration(request).get_result()
 
     # Unregister from conference
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        return self._conferenceRegistration(request, reg=False).get_result()
+
+    # Join the waitlist of a sold out conference
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST', name='joinWaitlist')
+    @instrumented
+    def joinWaitlist(self, request):
+        """Wait for a seat at a sold out conference; the user is
+        registered, and emailed, when one is given back. Returns False if
+        the user is waiting already."""
+        wsck = request.websafeConferenceKey
+        waiting = hasWaitersAsync(ndb.Key(urlsafe=wsck))
+        prof, conf = self._getWithProfileAsync(wsck).get_result()
+        if wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        conf = ensureSeatShards(conf)
+        # registration is refused while anyone waits, so then seats given
+        # back are for the waitlist to take; registration reads the
+        # shards, so read them here too
+        if not waiting.get_result() and countSeatsAvailable(conf) > 0:
+            raise ConflictException(
+                "There are seats available; register instead.")
+
+        joined = addWaiter(wsck, prof)
+        # a seat given back just now may have found the waitlist empty
+        if joined and getSeatsAvailable(conf) > 0:
+            taskqueue.add(params={'conference_key': wsck},
+                          url='/tasks/promote_waitlist')
+        return BooleanMessage(data=joined)
+
+    # Leave the waitlist of a conference
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='DELETE', name='leaveWaitlist')
+    @instrumented
+    def leaveWaitlist(self, request):
+        """Stop waiting for a seat at a conference. Returns False if the
+        user was not waiting."""
+        wsck = request.websafeConferenceKey
+        prof, conf = self._getWithProfileAsync(wsck).get_result()
+        return BooleanMessage(data=removeWaiter(wsck, prof.key))
+
+    @ndb.tasklet
+    def _getWithProfileAsync(self, wsck):
+        """Return the user Profile and the conference of wsck, getting
+        them concurrently; raise NotFoundException if there is no such
+        conference."""
+        prof, conf = yield (self._getProfileFromUserAsync(),
+                            ndb.Key(urlsafe=wsck).get_async())
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        raise ndb.Return((prof, conf))
+
+    @staticmethod
+    def _promoteWaitlist(c_key):
+        """Register waiters of a conference for the seats it has left;
+        used by the promote waitlist task. Returns whether there may be
+        more to promote."""
+        conf = c_key.get()
+        if not conf or not conf.seatShards:
+            return False
+        promoted, more = promoteWaiters(conf)
+        if promoted:
+            ConferenceApi._seatsChanged([(conf, -promoted)])
+        return more
+
+    @endpoints.method(ConferenceKeysForm, RegistrationResults,
+                      path='conferences/register',
+                      http_method='POST', name='registerForConferences')
+    @instrumented
+    def registerForConferences(self, request):
+        """Register user for several conferences, returning a result per
+        conference."""
+        prof = self._getProfileFromUser()
+
+        # check all the keys and get the conferences in one batch; keys
+        # given twice, however encoded, are registered once
+        errors = {}
+        c_keys = {}
+        canonical = {}
+        for given in set(request.websafeConferenceKeys):
+            try:
+                c_key = ndb.Key(urlsafe=given)
+            except (TypeError, ProtocolBufferDecodeError):
+                c_key = None
+            if not c_key or c_key.kind() != 'Conference':
+                errors[given] = 'Invalid conference key'
+                continue
+            wsck = canonical[given] = c_key.urlsafe()
+            if wsck in prof.conferenceKeysToAttend:
+                errors[wsck] = 'Already registered'
+            else:
+                c_keys[wsck] = c_key
+        waiting = [hasWaitersAsync(c_key) for c_key in c_keys.values()]
+        confs = {}
+        for wsck, conf, has_waiters in zip(
+                c_keys, ndb.get_multi(c_keys.values()), waiting):
+            if not conf:
+                errors[wsck] = 'No conference found'
+            elif has_waiters.get_result():
+                errors[wsck] = WAITLIST_FIRST
+            else:
+                confs[wsck] = ensureSeatShards(conf)
+
+        # the shards with seats left, in random order so concurrent
+        # registrations spread across them
+        shard_keys = dict((wsck, seatShardKeys(conf))
+                          for wsck, conf in confs.items())
+        shards = ndb.get_multi(
+            [key for keys in shard_keys.values() for key in keys])
+        seated = set(shard.key for shard in shards
+                     if shard and shard.seatsAvailable > 0)
+        for wsck in confs:
+            shard_keys[wsck] = [key for key in shard_keys[wsck]
+                                if key in seated]
+            random.shuffle(shard_keys[wsck])
+
+        # a batch of conferences per transaction; a conference whose
+        # picked shard ran out meanwhile tries its next shard in a later
+        # transaction
+        registered = []
+        pending = confs.keys()
+        while pending:
+            for wsck in pending:
+                if not shard_keys[wsck]:
+                    errors[wsck] = 'There are no seats available.'
+            pending = [wsck for wsck in pending if shard_keys[wsck]]
+            batch = pending[:MAX_XG_ENTITY_GROUPS - 1]
+            if not batch:
+                break
+            done, already = self._updateRegistration(
+                prof, [(wsck, shard_keys[wsck].pop()) for wsck in batch],
+                True).get_result()
+            for wsck in already:
+                errors[wsck] = 'Already registered'
+            registered.extend(done)
+            pending = [wsck for wsck in pending
+                       if wsck not in done and wsck not in already]
+        if registered:
+            # the transactions wrote their own copies of the profile
+            self._profile = None
+            self._seatsChanged([(confs[wsck], -1) for wsck in registered])
+
+        items = []
+        for given in request.websafeConferenceKeys:
+            wsck = canonical.get(given, given)
+            items.append(RegistrationResult(websafeConferenceKey=given,
+                                            registered=wsck not in errors,
+                                            error=errors.get(wsck)))
+        return RegistrationResults(items=items)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         # get user profile
@@ -496,93 +1085,182 @@ class ConferenceApi(remote.Service):
         conf_keys = [ndb.Key(urlsafe=wsck)
                      for wsck in prof.conferenceKeysToAttend]
 
-        # fetch conferences from datastore.
-        # Use get_multi(array_of_keys) to fetch all keys at once.
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # fetch conferences from datastore, together with organizers'
+        # display names in a dict for easier fetching
+        conferences, names = self._getConferencesWithOrganizersAsync(
+            conf_keys).get_result()
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, "")
-                                      for conf in conferences]
-                               )
+        return ConferenceForms(
+            items=self._conferenceFormsAsync(conferences, names).get_result()
+        )
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
+    def _setAnnouncement(index):
+        """Format Announcement from the NearlySoldOut index & assign to
+        memcache, unless it holds one from a later version of the index."""
+        conferences = index.conferences if index else {}
+        version = index.version if index else 0
+        if conferences:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
             announcement = '%s %s' % (
                 'Last chance to attend! The following conferences '
                 'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+                ', '.join(sorted(conferences.values())))
         else:
             # If there are no sold out conferences,
-            # delete the memcache announcements entry
+            # cache the empty announcement
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
+        # concurrent updates may get here in any order, so the cached
+        # (version, announcement) is only replaced by a later version
+        client = memcache.Client()
+        for _ in range(10):
+            cached = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if cached is None:
+                if client.add(MEMCACHE_ANNOUNCEMENTS_KEY,
+                              (version, announcement)):
+                    break
+            elif cached[0] >= version:
+                break
+            elif client.cas(MEMCACHE_ANNOUNCEMENTS_KEY,
+                            (version, announcement)):
+                break
         return announcement
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @staticmethod
+    def _updateNearlySoldOut(conf):
+        """Add conf to or drop it from the nearly sold out conferences,
+        according to its (synced) seatsAvailable, & refresh Announcement;
+        used by the seat sync task whenever seats change."""
+        index = NEARLY_SOLD_OUT_KEY.get()
+        # most syncs are of conferences far from sell-out and leave the
+        # index as it is, so only open a transaction to change it
+        if not index or ConferenceApi._nearlySoldOutChanges(index, conf):
+            index = ConferenceApi._updateNearlySoldOutTxn(conf)
+        return ConferenceApi._setAnnouncement(index)
+
+    @staticmethod
+    def _nearlySoldOutChanges(index, conf):
+        """Return whether the nearly sold out index must change for conf's
+        seatsAvailable."""
+        wsck = conf.key.urlsafe()
+        if 0 < conf.seatsAvailable <= NEARLY_SOLD_OUT_SEATS:
+            return index.conferences.get(wsck) != conf.name
+        return wsck in index.conferences
+
+    @staticmethod
+    @ndb.transactional
+    def _updateNearlySoldOutTxn(conf):
+        index = NEARLY_SOLD_OUT_KEY.get() or NearlySoldOut(
+            key=NEARLY_SOLD_OUT_KEY, conferences={})
+        if not ConferenceApi._nearlySoldOutChanges(index, conf):
+            return index
+        wsck = conf.key.urlsafe()
+        if 0 < conf.seatsAvailable <= NEARLY_SOLD_OUT_SEATS:
+            index.conferences[wsck] = conf.name
+        else:
+            del index.conferences[wsck]
+        index.version += 1
+        index.put()
+        return index
+
+    @staticmethod
+    def _checkNearlySoldOut():
+        """Compare the nearly sold out conferences index with a query over
+        all conferences. Returns (scanned, indexed, stale): the names of
+        the conferences found by the query and of those in the index, by
+        websafe key, and the keys whose index entry differs."""
+        confs = Conference.query(ndb.AND(
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+            Conference.seatsAvailable > 0)
+        ).fetch(projection=[Conference.name])
+        scanned = {conf.key.urlsafe(): conf.name for conf in confs}
+
+        index = NEARLY_SOLD_OUT_KEY.get()
+        indexed = index.conferences if index else {}
+        stale = [wsck for wsck in set(scanned) | set(indexed)
+                 if indexed.get(wsck) != scanned.get(wsck)]
+        return scanned, indexed, stale
+
+    @staticmethod
+    @ndb.transactional
+    def _reconcileNearlySoldOutTxn(scanned, indexed, stale):
+        """Set the stale index entries to what the query found, except
+        those changed since indexed was read: the seat sync task wrote
+        them from seat counts newer than the query's."""
+        index = NEARLY_SOLD_OUT_KEY.get() or NearlySoldOut(
+            key=NEARLY_SOLD_OUT_KEY, conferences={})
+        conferences = index.conferences
+        fixed = [wsck for wsck in stale
+                 if conferences.get(wsck) == indexed.get(wsck)]
+        if fixed:
+            for wsck in fixed:
+                if wsck in scanned:
+                    conferences[wsck] = scanned[wsck]
+                else:
+                    del conferences[wsck]
+            index.version += 1
+            index.put()
+        return index
+
+    @staticmethod
+    def _cacheAnnouncement():
+        """Reconcile the nearly sold out conferences index with the
+        datastore, then create Announcement & assign to memcache; used by
+        memcache cron job & putAnnouncement().
+        """
+        scanned, indexed, stale = ConferenceApi._checkNearlySoldOut()
+        if stale:
+            logging.warning('Nearly sold out index out of date for %s',
+                            stale)
+            index = ConferenceApi._reconcileNearlySoldOutTxn(
+                scanned, indexed, stale)
+        else:
+            index = NEARLY_SOLD_OUT_KEY.get()
+        return ConferenceApi._setAnnouncement(index)
+
+    @endpoints.method(ANNOUNCEMENT_GET_REQUEST, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        """Return Announcement from memcache, or just notModified if its
+        etag is ifNoneMatch."""
+        # return an existing announcement from Memcache, rebuilding it
+        # from the nearly sold out conferences if it was evicted.
+        cached = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if cached is None:
+            announcement = self._setAnnouncement(NEARLY_SOLD_OUT_KEY.get())
+        else:
+            announcement = cached[1]
+        # the announcement is read anyway, so its hash is the etag
+        etag = hashlib.md5(announcement.encode('utf-8')).hexdigest()
+        if request.ifNoneMatch == etag:
+            return StringMessage(data='', etag=etag, notModified=True)
+        return StringMessage(data=announcement, etag=etag)
 
 
 # -------------------Sessions objects-------------------------------------
 
     def _copySessionToForm(self, session):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(session, field.name):
-                # convert Date to date string; just copy others
-                if field.name.startswith(
-                        'dat') or field.name.startswith('start'):
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                else:
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-            if field.name == "websafeSessionKey":
-                setattr(sf,  field.name, session.key.urlsafe())
-            if field.name == "websafeConferenceKey":
-                setattr(sf,  field.name, session.key.parent().urlsafe())
-        sf.check_initialized()
-        return sf
+        return SESSION_PLAN.copy(session)
 
-    def _createSessionObject(self, request):
-        """Create Session object, returning SessionForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    def _sessionPlan(self, fields):
+        """Return the CopyPlan filling in fields of SessionForms."""
+        return SESSION_PLAN.masked(fields) if fields else SESSION_PLAN
 
+    def _maskedValues(self, values, fields):
+        """Return the message field values named in fields, or all of
+        them if fields is None, as str keyword arguments."""
+        return dict((str(name), value) for name, value in values.items()
+                    if fields is None or name in fields)
+
+    def _sessionData(self, request):
+        """Return the Session properties given in a SessionForm."""
         if not request.name:
             raise endpoints.BadRequestException(
                 "Session 'name' field required")
@@ -590,6 +1268,14 @@ class ConferenceApi(remote.Service):
         # copy SessionForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
+        del data['websafeConferenceKey']
+        del data['websafeSessionKey']
+
+        if data['speaker'] and \
+                len(data['speaker'].encode('utf-8')) > MAX_SPEAKER_BYTES:
+            raise endpoints.BadRequestException(
+                "Session 'speaker' must be at most %d bytes" %
+                MAX_SPEAKER_BYTES)
 
         # convert dates from strings to Date objects;
         if data['date']:
@@ -600,100 +1286,401 @@ class ConferenceApi(remote.Service):
         if data['startTime']:
             data['startTime'] = datetime.strptime(
                 data['startTime'], "%H:%M").time()
-        mykey = data['websafeConferenceKey']
-        conf = ndb.Key(urlsafe=data['websafeConferenceKey']).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' %
-                request.websafeConferenceKey)
 
+        # keep the duration in minutes and the end time it gives, so
+        # sessions can be searched by them
+        if data['durationMinutes'] is not None and \
+                data['durationMinutes'] <= 0:
+            raise endpoints.BadRequestException(
+                "Session 'durationMinutes' must be positive")
+        data['durationMinutes'] = (data['durationMinutes'] or
+                                   parseDuration(data['duration']))
+        data['endTime'] = endTime(data['startTime'],
+                                  data['durationMinutes'])
+        return data
+
+    @ndb.tasklet
+    def _allocateSessionKeysAsync(self, wsck, size):
+        """Check that the user created the conference and allocate size
+        new Session keys under it."""
         # Retrieve Conference key
-        c_key = conf.key
+        c_key = ndb.Key(urlsafe=wsck)
+
+        # get the conference and user profile and allocate new Session IDs
+        # with Conference key as parent, all concurrently
+        conf, profile, (first, last) = yield (
+            c_key.get_async(),
+            self._getProfileFromUserAsync(),
+            Session.allocate_ids_async(size=size, parent=c_key))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
 
         # Make sure that only creator of conference can add sessions to
         # conference:
         parent_id = conf.key.parent().id()
-        profile = self._getProfileFromUser()
         p_id = profile.key.id()
 
         if parent_id != p_id:
             raise endpoints.UnauthorizedException(
                 'Only creator of the conference can add sessions')
 
-        # allocate new Session ID with Conference key as parent
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        # make Session key from ID
-        s_key = ndb.Key(Session, s_id, parent=c_key)
-        data['key'] = s_key
-        del data['websafeConferenceKey']
-        del data['websafeSessionKey']
+        # make Session keys from IDs
+        raise ndb.Return([ndb.Key(Session, s_id, parent=c_key)
+                          for s_id in range(first, last + 1)])
+
+    def _sessionsChanged(self, wsck, speaker_sessions):
+        """Start a new version of the conference's sessions and enqueue the
+        featured speaker task for each speaker with more than one session
+        at the conference."""
+        bumpVersions(sessionsVersion(wsck))
+        self._addFeaturedSpeakerTasks(wsck, speaker_sessions)
+
+    def _addFeaturedSpeakerTasks(self, wsck, speaker_sessions):
+        """Enqueue the featured speaker task for each speaker with more
+        than one session at the conference."""
+        # This is a task to set the speaker as featured speaker, once
+        # they present more than once at the conference.
+        tasks = [taskqueue.Task(params={'speaker': speaker,
+                                        'conference_key': wsck},
+                                url='/tasks/featured_speaker')
+                 for speaker, count in speaker_sessions.items() if count > 1]
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+    @ndb.tasklet
+    def _createSessionObject(self, request):
+        """Create Session object, returning SessionForm/request."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
 
-        # Commit session to NDB
-        session = Session(**data)
-        session.put()
-        # Session(**data).put()
+        data = self._sessionData(request)
+        mykey = request.websafeConferenceKey
+        data['key'], = yield self._allocateSessionKeysAsync(mykey, 1)
 
-        # This is a task to check if the speaker should be a
-        # featured speaker.
-        taskqueue.add(params={'speaker': request.speaker,
-                              'conference_key': mykey},
-                      url='/tasks/featured_speaker')
-        return self._copySessionToForm(session)
+        # Commit session to NDB together with its speaker index
+        session = Session(**data)
+        speaker_sessions = yield self._putSessionsAndIndexes([session])
+        self._sessionsChanged(mykey, speaker_sessions)
+        raise ndb.Return(self._copySessionToForm(session))
+
+    @ndb.transactional_tasklet
+    def _putSessionsAndIndexes(self, sessions):
+        """Put Sessions of one conference and add them to its AgendaDays
+        and their speakers' SpeakerIndex, returning the number of sessions of
+        each of those speakers at the conference."""
+        c_key = sessions[0].key.parent()
+        speakers = sorted(set(session.speaker for session in sessions
+                              if session.speaker))
+        day_keys = agendaDayKeys(c_key, sessions)
+        found = yield ndb.get_multi_async(
+            [agendaKey(c_key)] + day_keys +
+            [ndb.Key(SpeakerIndex, speaker, parent=c_key)
+             for speaker in speakers])
+        agenda = found[0]
+        days = dict((day.key.id(), day)
+                    for day in found[1:len(day_keys) + 1] if day)
+        indexes = dict(zip(speakers, found[len(day_keys) + 1:]))
+
+        if agenda:
+            agenda_entities = addSessions(c_key, days, sessions)
+        else:
+            # start from sessions created before the agenda existed
+            existing = yield Session.query(ancestor=c_key).fetch_async()
+            agenda, days = newAgenda(c_key, existing + sessions)
+            agenda_entities = [agenda] + days.values()
+
+        # start from sessions created before the index existed
+        missing = [speaker for speaker in speakers if not indexes[speaker]]
+        names = yield [Session.query(ancestor=c_key).filter(
+            Session.speaker == speaker).map_async(lambda sess: sess.name)
+            for speaker in missing]
+        for speaker, speaker_names in zip(missing, names):
+            indexes[speaker] = SpeakerIndex(id=speaker, parent=c_key,
+                                            sessionNames=speaker_names)
+
+        for session in sessions:
+            if session.speaker:
+                indexes[session.speaker].sessionNames.append(session.name)
+        yield ndb.put_multi_async(
+            sessions + indexes.values() + agenda_entities)
+        # add the sessions to their Speakers once they are committed
+        session_keys = [session.key.urlsafe() for session in sessions
+                        if speakerKey(session.speaker)]
+        if session_keys:
+            taskqueue.add(params={'session_keys': session_keys},
+                          url='/tasks/add_speaker_sessions',
+                          transactional=True)
+        raise ndb.Return(dict((speaker, len(index.sessionNames))
+                              for speaker, index in indexes.items()))
 
     @endpoints.method(SessionForm, SessionForm, path='session',
                       http_method='POST', name='createSession')
+    @instrumented
     def createSession(self, request):
         """Create new session."""
-        return self._createSessionObject(request)
+        return self._createSessionObject(request).get_result()
+
+    @endpoints.method(SESSIONS_POST_REQUEST, SessionForms,
+                      path='conference/{websafeConferenceKey}/sessions',
+                      http_method='POST', name='createSessions')
+    @instrumented
+    def createSessions(self, request):
+        """Create many sessions of a conference, e.g. a whole agenda."""
+        wsck = request.websafeConferenceKey
+        data = [self._sessionData(sf) for sf in request.items]
+        if not data:
+            return SessionForms()
+        s_keys = self._allocateSessionKeysAsync(
+            wsck, len(data)).get_result()
+        sessions = [Session(key=s_key, **d) for s_key, d in zip(s_keys, data)]
+
+        # one transaction per batch; the conference's entity group takes
+        # the sessions and their speaker indexes together
+        speaker_sessions = {}
+        for i in range(0, len(sessions), SESSION_PUT_BATCH_SIZE):
+            speaker_sessions.update(self._putSessionsAndIndexes(
+                sessions[i:i + SESSION_PUT_BATCH_SIZE]).get_result())
+        self._sessionsChanged(wsck, speaker_sessions)
+        return SessionForms(items=SESSION_PLAN.copyMulti(sessions))
 
     # Given a conference, returns all sessions
     @endpoints.method(SESSION_GET_REQUEST, SessionForms,
                       path='getSessions',
                       http_method='GET',
                       name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
-        """Query for all sessions for a given conference."""
+        """Query for all sessions for a given conference, by date and
+        start time, or only those of typeOfSession; or just notModified
+        if their etag is ifNoneMatch."""
         wsck = request.websafeConferenceKey
-        conf_key = ndb.Key(urlsafe=wsck)
-        sessions = Session.query(ancestor=conf_key)
-        # return individual SessionForm object per Conference
+        fields = self._fieldMask(SessionForm, request.fields)
+        page_size = self._pageSize(request.pageSize)
+        offset = self._pageOffset(request.pageToken)
+        # read the version first, so the sessions are at least as new
+        etag = requestTag(
+            getVersion(sessionsVersion(wsck)), page_size, offset,
+            sorted(fields or []), request.typeOfSession)
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+        days = getAgenda(ndb.Key(urlsafe=wsck))
+        if days is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        sessions = agendaSessions(days, request.typeOfSession)
+        next_token = None
+        if offset + page_size < len(sessions):
+            next_token = str(offset + page_size)
+        # return individual SessionForm object per Session
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=[SessionForm(**self._maskedValues(values, fields))
+                   for values in sessions[offset:offset + page_size]],
+            nextPageToken=next_token, etag=etag)
+
+    def _sessionSearchFilters(self, request):
+        """Return the filters of a session search, in the form of
+        queryConferences filters."""
+        filters = []
+        for field, operator, value in (
+                ('startTime', '>=', request.startAfter),
+                ('endTime', '<=', request.endBefore)):
+            if value:
+                try:
+                    value = datetime.strptime(value, "%H:%M").time()
+                except ValueError:
+                    raise endpoints.BadRequestException(
+                        'Times are in 24 hour notation, e.g. 14:00')
+                filters.append(
+                    {'field': field, 'operator': operator, 'value': value})
+        if request.maxDuration is not None:
+            filters.append({'field': 'durationMinutes', 'operator': '<=',
+                            'value': request.maxDuration})
+        if request.typeOfSession:
+            filters.append({'field': 'typeOfSession', 'operator': '=',
+                            'value': request.typeOfSession})
+        if not filters:
+            raise endpoints.BadRequestException(
+                'Search by startAfter, endBefore, maxDuration or '
+                'typeOfSession')
+        return filters
+
+    def _sessionQuery(self, c_key, filtr):
+        """Return the query for a conference's sessions matching
+        filtr."""
+        prop = Session._properties[filtr['field']]
+        q = Session.query(MATCHERS[filtr['operator']](prop, filtr['value']),
+                          ancestor=c_key)
+        if filtr['operator'] != '=':
+            # unset values sort first; leave them out of upper bounds
+            if filtr['operator'].startswith('<'):
+                q = q.filter(prop > None)
+            q = q.order(prop)
+        return q
+
+    @ndb.tasklet
+    def _mostSelectiveAsync(self, c_key, filters):
+        """Return the filter matching the fewest sessions of a
+        conference, counting them all concurrently."""
+        if len(filters) == 1:
+            raise ndb.Return(filters[0])
+        counts = yield [self._sessionQuery(c_key, filtr).count_async(
+            limit=SESSION_COUNT_LIMIT) for filtr in filters]
+        raise ndb.Return(filters[counts.index(min(counts))])
+
+    # Search for Sessions by time window, duration and type.
+    @endpoints.method(SESSION_SEARCH_REQUEST, SessionForms,
+                      path='conference/{websafeConferenceKey}/sessions/'
+                           'search',
+                      http_method='GET',
+                      name='searchSessions')
+    @instrumented
+    def searchSessions(self, request):
+        """Query for the sessions of a conference starting at or after
+        startAfter, ending at or before endBefore, lasting at most
+        maxDuration minutes and of typeOfSession, whichever are given."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        filters = self._sessionSearchFilters(request)
+        fields = self._fieldMask(SessionForm, request.fields)
+        page_size = self._pageSize(request.pageSize)
+
+        # The most selective filter runs in the datastore, the others in
+        # memory. Page tokens name the filter run, so later pages continue
+        # the same query.
+        cursor = None
+        if request.pageToken:
+            field, _, websafe_cursor = request.pageToken.partition(' ')
+            run = [filtr for filtr in filters if filtr['field'] == field]
+            try:
+                cursor = ndb.Cursor(urlsafe=websafe_cursor)
+            except datastore_errors.BadValueError:
+                run = None
+            if not run:
+                raise endpoints.BadRequestException(
+                    'Invalid page token: %s' % request.pageToken)
+            run = run[0]
+        else:
+            run = self._mostSelectiveAsync(c_key, filters).get_result()
+
+        sessions = []
+        it = self._sessionQuery(c_key, run).iter(
+            start_cursor=cursor, produce_cursors=True)
+        for session in it:
+            if all(getattr(session, filtr['field']) is not None and
+                   MATCHERS[filtr['operator']](
+                       getattr(session, filtr['field']), filtr['value'])
+                   for filtr in filters):
+                sessions.append(session)
+                if len(sessions) == page_size:
+                    break
+        next_token = None
+        if len(sessions) == page_size and it.probably_has_next():
+            next_token = '%s %s' % (run['field'],
+                                    it.cursor_after().urlsafe())
+        return SessionForms(
+            items=self._sessionPlan(fields).copyMulti(sessions),
+            nextPageToken=next_token)
 
     # Query for Sessions by type.
     @endpoints.method(SESSION_BYTYPE_GET_REQUEST, SessionForms,
                       path='getSessionsbyType',
                       http_method='POST',
                       name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """Query for Sessions by type of session."""
         wsck = request.websafeConferenceKey
         session_type = request.typeOfSession
         conf_key = ndb.Key(urlsafe=wsck)
+        fields = self._fieldMask(SessionForm, request.fields)
         sessions = Session.query(ancestor=conf_key)
         sessions = sessions.filter(
-            Session.typeOfSession == session_type)
+            Session.typeOfSession == session_type).fetch()
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=self._sessionPlan(fields).copyMulti(sessions))
 
     # Query for particular speaker across all conferences
     @endpoints.method(SESSIONS_BY_SPEAKER_GET_REQUEST, SessionForms,
                       path='getSpeakerSessions',
                       http_method='POST',
                       name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
-        """Query for Sessions by speaker."""
-        speaker = request.speaker
-        sessions = Session.query()
-        sessions = sessions.filter(Session.speaker == speaker)
+        """Query for Sessions by speaker, at all conferences."""
+        fields = self._fieldMask(SessionForm, request.fields)
+        sessions = getSpeakerSessions(request.speaker)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=self._sessionPlan(fields).copyMulti(sessions))
+
+    def _newWishlistEntry(self, p_key, session, **kwargs):
+        """Return WishlistEntry of session in the wishlist of p_key."""
+        entry = WishlistEntry(id=session.key.urlsafe(), parent=p_key,
+                              typeOfSession=session.typeOfSession,
+                              speaker=session.speaker, **kwargs)
+        self._cacheInterval(entry, session)
+        return entry
+
+    def _cacheInterval(self, entry, session):
+        """Copy the name and interval of session to its WishlistEntry."""
+        entry.name = session.name
+        entry.date, entry.startMinutes, entry.endMinutes = (
+            sessionInterval(session) or (None, None, None))
+        entry.intervalCached = True
+
+    def _migrateWishlist(self, prof):
+        """Move a wishlist kept in Profile.wishlistSessionKeys to
+        WishlistEntry children of the Profile, keeping its order."""
+        if not prof.wishlistSessionKeys:
+            return
+        session_keys = [ndb.Key(urlsafe=session_key)
+                        for session_key in prof.wishlistSessionKeys]
+        added = datetime.now()
+        entries = [self._newWishlistEntry(
+            prof.key, session, added=added + timedelta(microseconds=i))
+            for i, session in enumerate(ndb.get_multi(session_keys))
+            if session]
+        # duplicates get the same key; keep the first one
+        entries = {entry.key: entry for entry in reversed(entries)}.values()
+        # too many for one transaction; the keys are the session keys, so
+        # a migration failing part way is completed by the next one
+        for i in range(0, len(entries), WISHLIST_MIGRATION_BATCH_SIZE):
+            ndb.put_multi(entries[i:i + WISHLIST_MIGRATION_BATCH_SIZE])
+        self._clearLegacyWishlist(prof.key)
+        self._profile = None
+
+    @ndb.transactional
+    def _clearLegacyWishlist(self, p_key):
+        prof = p_key.get()
+        prof.wishlistSessionKeys = []
+        prof.put()
+
+    def _getWishlist(self, *filters):
+        """Return Sessions in user wishlist, in the order they were added,
+        whose WishlistEntry matches filters."""
+        # Get user profile
+        prof = self._getProfileFromUser()
+        self._migrateWishlist(prof)
+
+        # Get session keys of the matching entries, which are the entry
+        # ids, with a keys only query
+        q = WishlistEntry.query(*filters, ancestor=prof.key)
+        entry_keys = q.order(WishlistEntry.added).fetch(keys_only=True)
+        session_keys = [ndb.Key(urlsafe=entry_key.id())
+                        for entry_key in entry_keys]
+
+        # Fetch sessions from datastore.
+        # Use get_multi(array_of_keys) to fetch all keys at once.
+        return [session for session in ndb.get_multi(session_keys)
+                if session]
 
     # Add session to Wishlist
     @endpoints.method(WISH_LIST_GET_REQUEST, StringMessage,
                       path='addToWishList',
                       http_method='POST',
                       name='addSessionToWishlist')
+    @instrumented
     def addSessionToWishlist(self, request):
         """Add Session to Wish List"""
         prof = self._getProfileFromUser()  # get user Profile
@@ -706,108 +1693,129 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % session_key)
 
-        # Add a session key to profile
-        prof.wishlistSessionKeys.append(session_key)
-
-        # write things back to the datastore & return
-        prof.put()
+        # Add a session to the wishlist, unless it is in it already
+        self._migrateWishlist(prof)
+        entry = self._newWishlistEntry(prof.key, session)
+        if not entry.key.get():
+            entry.put()
         return StringMessage(data=session_key)
 
     # Retrieve Wishlist
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='sessionwishlist',
                       http_method='GET', name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Get list of sessions from user wishlist."""
-        # Get user profile
-        prof = self._getProfileFromUser()
-
-        # Get wishlistSessionKeys from profile.
-        session_keys = [ndb.Key(urlsafe=session_key)
-                        for session_key in prof.wishlistSessionKeys]
-
-        # Fetch session from datastore.
-        # Use get_multi(array_of_keys) to fetch all keys at once.
-        sessions = ndb.get_multi(session_keys)
-        
-
         # return set of SessionForm objects per Session
-        return SessionForms(items=[self._copySessionToForm(session)
-                                   for session in sessions]
-                            )
+        return SessionForms(
+            items=SESSION_PLAN.copyMulti(self._getWishlist()))
 
     # Retrieve Wishlist by type
     @endpoints.method(WISH_LIST_BYTYPE_GET_REQUEST, SessionForms,
                       path='sessionwishlistbytype',
                       http_method='GET', name='getWishlistbyType')
+    @instrumented
     def wishlist_by_Type(self, request):
         """Get list of sessions from user wishlist by type."""
-        # Get user profile
-        prof = self._getProfileFromUser()
-        session_type = request.typeOfSession
-        # Get wishlistSessionKeys from profile.
-        session_keys = [ndb.Key(urlsafe=session_key)
-                        for session_key in prof.wishlistSessionKeys]
-        sessions = ndb.get_multi(session_keys)
-        # Using List comprehension for wish list
-        wishlist = [session for session in sessions
-                    if session.typeOfSession == session_type]
-        # Alternative way to list comprehension avove
-        # wishlist = []
-        # for session in sessions:
-        #     if session.typeOfSession == session_type:
-        #         wishlist.append(session)
-        return SessionForms(items=[self._copySessionToForm(wish)
-                                   for wish in wishlist]
-                            )
+        wishlist = self._getWishlist(
+            WishlistEntry.typeOfSession == request.typeOfSession)
+        return SessionForms(items=SESSION_PLAN.copyMulti(wishlist))
 
     # Retrieve Wishlist by Speaker
     @endpoints.method(WISH_LIST_BYSPEAKER_GET_REQUEST, SessionForms,
                       path='sessionwishlistbyspeaker',
                       http_method='GET', name='getWishlistbySpeaker')
+    @instrumented
     def wishlist_by_Speaker(self, request):
         """Get list of sessions from user wishlist by speaker."""
-        # Get user profile
+        wishlist = self._getWishlist(
+            WishlistEntry.speaker == request.speaker)
+        return SessionForms(items=SESSION_PLAN.copyMulti(wishlist))
+
+    # Overlapping sessions in Wishlist
+    @endpoints.method(message_types.VoidMessage, WishlistConflictForms,
+                      path='sessionwishlist/conflicts',
+                      http_method='GET', name='getWishlistConflicts')
+    @instrumented
+    def getWishlistConflicts(self, request):
+        """Return each pair of sessions in user wishlist that overlap."""
         prof = self._getProfileFromUser()
-        session_speaker = request.speaker
-        # Get wishlistSessionKeys from profile.
-        session_keys = [ndb.Key(urlsafe=session_key)
-                        for session_key in prof.wishlistSessionKeys]
-        sessions = ndb.get_multi(session_keys)
-        # Using List comprehension for wish list
-        wishlist = [session for session in sessions
-                    if session.speaker == session_speaker]
-        return SessionForms(items=[self._copySessionToForm(wish)
-                                   for wish in wishlist]
-                            )
+        self._migrateWishlist(prof)
+        entries = WishlistEntry.query(ancestor=prof.key).fetch()
+
+        # copy intervals to entries added before they were, once
+        stale = [entry for entry in entries if not entry.intervalCached]
+        if stale:
+            sessions = ndb.get_multi([ndb.Key(urlsafe=entry.key.id())
+                                      for entry in stale])
+            stale = [(entry, session)
+                     for entry, session in zip(stale, sessions) if session]
+            for entry, session in stale:
+                self._cacheInterval(entry, session)
+            ndb.put_multi([entry for entry, session in stale])
+
+        conflicts = findConflicts(
+            [(entry.date, entry.startMinutes, entry.endMinutes, entry)
+             for entry in entries
+             if entry.intervalCached and entry.startMinutes is not None])
+        return WishlistConflictForms(items=[
+            WishlistConflictForm(
+                date=str(date),
+                websafeSessionKeys=[first.key.id(), second.key.id()],
+                names=[first.name, second.name],
+                overlapStart=formatMinutes(start),
+                overlapEnd=formatMinutes(end))
+            for date, start, end, first, second in conflicts])
 
     # Solution to query related problem
     @endpoints.method(PROBLEM_QUERY_PARAM_GET_REQUEST, SessionForms,
                       path='problemquery',
                       http_method='GET', name='problemQuery')
+    @instrumented
     def twoIneqFiltersOnDifProp(self, request):
         """Two inequality filters on different properties."""
         session_type = request.typeOfSession
         start_time = request.startTime
         start_time = datetime.strptime(start_time, "%H:%M").time()
-        q = Session.query()
-        q = q.filter(Session.typeOfSession != session_type)
-        print q
-        p = Session.query()
-        p = p.filter(Session.startTime < start_time)
-        my_results = []
-        for session in p:
-            for sess in q:
-                if (session == sess and session.startTime is not None and
-                        sess.typeOfSession is not None):
-                            my_results.append(session)
-        return SessionForms(items=[self._copySessionToForm(each_result)
-                                   for each_result in my_results])
+
+        # Only the startTime inequality goes to the datastore. The
+        # projection is served straight from the (startTime, typeOfSession)
+        # index, so no full entity is read for sessions that get filtered
+        # out below.
+        if request.websafeConferenceKey:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            q = Session.query(ancestor=conf_key)
+        else:
+            q = Session.query()
+        q = q.filter(Session.startTime < start_time)
+        q = q.order(Session.startTime)
+
+        # The typeOfSession inequality is applied in memory, reading on
+        # until the page is full. Null values sort before everything else,
+        # so both inequalities would match unset properties; skip those
+        # explicitly.
+        rows, next_token = self._fetchPage(
+            q, request.pageSize, request.pageToken,
+            keep=lambda row: (row.startTime is not None and
+                              row.typeOfSession is not None and
+                              row.typeOfSession != session_type),
+            projection=PROBLEM_QUERY_PROJECTION)
+        fields = self._fieldMask(SessionForm, request.fields)
+        if self._projection(Session, fields, PROBLEM_QUERY_PROJECTION):
+            # the rows already hold every field asked for
+            sessions = rows
+        else:
+            sessions = ndb.get_multi([row.key for row in rows])
+        return SessionForms(
+            items=self._sessionPlan(fields).copyMulti(sessions),
+            nextPageToken=next_token)
 
     # Get Featured Speaker
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='session/featured/get',
                       http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
         """Return Featured speaker from memcache."""
         featured = memcache.get(MEMCACHE_FEATURED_SPEAKER)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+""" Conference creation confirmation emails
+
+Creating a conference adds a small record to a pull queue, tagged with
+the organizer's email. A cron job leases the records of one organizer at
+a time by tag and sends each organizer one digest of the conferences they
+created, a few mails at a time. Records whose digest could not be sent
+are leased again once their lease runs out."""
+
+import json
+import logging
+import threading
+import time
+import Queue
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+
+CONFIRMATION_QUEUE = 'confirmation-email'
+LEASE_SECONDS = 60
+LEASE_BATCH_SIZE = 100
+# lease rounds, each of one organizer's records, per run, leaving the next
+# cron run what is left
+MAX_LEASE_ROUNDS = 20
+MAIL_CONCURRENCY = 4
+
+
+class AppEngineMailer(object):
+    """AppEngineMailer -- sends mail with the App Engine mail API"""
+
+    def send(self, to, subject, body):
+        mail.send_mail(
+            'noreply@%s.appspotmail.com' % (
+                app_identity.get_application_id()),     # from
+            to, subject, body)
+
+
+class LocalMailer(object):
+    """LocalMailer -- stand-in for the mail API that records the mails it
+    is given, optionally taking latency seconds per mail"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, subject, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent.append((to, subject, body))
+
+
+def enqueueConfirmation(email, conf):
+    """Queue a confirmation email to email for Conference conf."""
+    record = {
+        'email': email,
+        'name': conf.name,
+        'city': conf.city,
+        'startDate': conf.startDate and str(conf.startDate),
+        'endDate': conf.endDate and str(conf.endDate),
+        'maxAttendees': conf.maxAttendees,
+        'topics': conf.topics,
+    }
+    taskqueue.Queue(CONFIRMATION_QUEUE).add(
+        taskqueue.Task(payload=json.dumps(record), method='PULL',
+                       tag=email))
+
+
+def sendPromotion(email, name, mailer=None):
+    """Tell email they are registered for conference name, from its
+    waitlist."""
+    (mailer or AppEngineMailer()).send(
+        email, 'You are registered for %s!' % name,
+        'Hi, a seat opened up at %s and you were next on its waitlist, '
+        'so you are now registered for it.' % name)
+
+
+def renderDigest(records):
+    """Return the subject and body of the email confirming the
+    conferences in records."""
+    if len(records) == 1:
+        subject = 'You created a new Conference!'
+    else:
+        subject = 'You created %d new Conferences!' % len(records)
+    lines = ['Hi, you have created the following conferences:', '']
+    for record in records:
+        dates = ' to '.join(date for date in (record['startDate'],
+                                              record['endDate']) if date)
+        lines.append('%(name)s, %(city)s' % record)
+        lines.append('  %s, max %s attendees' % (
+            dates or 'Dates to be announced', record['maxAttendees']))
+        lines.append('  Topics: %s' % ', '.join(record['topics'] or []))
+        lines.append('')
+    return subject, '\r\n'.join(lines)
+
+
+def _sendDigests(mailer, digests, concurrency):
+    """Send digests, a list of (to, subject, body, tasks), with at most
+    concurrency mails in flight. Returns the digests sent."""
+    pending = Queue.Queue()
+    for digest in digests:
+        pending.put(digest)
+    sent = []
+
+    def work():
+        while True:
+            try:
+                to, subject, body, tasks = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                mailer.send(to, subject, body)
+            except Exception:
+                logging.exception('Confirmation email to %s failed', to)
+            else:
+                sent.append((to, subject, body, tasks))
+
+    workers = [threading.Thread(target=work)
+               for _ in range(min(concurrency, len(digests)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sent
+
+
+def sendConfirmations(mailer=None, concurrency=MAIL_CONCURRENCY):
+    """Lease queued confirmations and send one digest per recipient.
+    Returns the number of digests sent."""
+    mailer = mailer or AppEngineMailer()
+    queue = taskqueue.Queue(CONFIRMATION_QUEUE)
+    tasks = []
+    for _ in range(MAX_LEASE_ROUNDS):
+        # the records tagged like the oldest one, i.e. of one organizer;
+        # records queued untagged are leased together
+        leased = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_BATCH_SIZE)
+        if not leased:
+            break
+        tasks.extend(leased)
+
+    # group by recipient, keeping creation order within a digest
+    by_email = {}
+    for task in tasks:
+        record = json.loads(task.payload)
+        records, email_tasks = by_email.setdefault(record['email'], ([], []))
+        records.append(record)
+        email_tasks.append(task)
+    digests = [(email,) + renderDigest(records) + (email_tasks,)
+               for email, (records, email_tasks) in by_email.items()]
+
+    sent = _sendDigests(mailer, digests, concurrency)
+    if sent:
+        queue.delete_tasks([task for digest in sent for task in digest[3]])
+    return len(sent)
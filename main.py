@@ -1,17 +1,33 @@
 #!/usr/bin/env python
+import json
 import webapp2
 from google.appengine.ext import ndb
-from models import Session
+from models import SpeakerIndex
 from google.appengine.api import app_identity
 from google.appengine.api import mail
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from conference import ConferenceApi
+from conference import CONFERENCE_FORM_CACHE
+from catalog import CATALOG_MAX_AGE
+from catalog import buildCatalog
+from catalog import getCatalog
+from catalog import gunzip
+from emails import sendConfirmations
+from emails import sendPromotion
+from schedule import migrateDurations
+from seats import syncSeatsAvailable
+from speakers import addSessions
+from speakers import backfillSpeakers
+from stats import instrumented
+from stats import report
 
 MEMCACHE_FEATURED_SPEAKER = "FEATURED SPEAKER FOR THIS CONFERENCE"
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
 
+    @instrumented
     def get(self):
         """Set Announcement in Memcache."""
         # _cacheAnnouncement() sets announcement in Memcache
@@ -19,8 +35,76 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class BuildCatalogHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Rebuild the snapshot of upcoming conferences."""
+        buildCatalog()
+        self.response.set_status(204)
+
+
+class CatalogHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Serve the snapshot of upcoming conferences as gzipped JSON,
+        or 304 if the client's copy is current."""
+        etag, data = getCatalog()
+        gzipped = 'gzip' in self.request.accept_encoding
+        # the two encodings are different representations, so they must
+        # not share an ETag
+        if gzipped:
+            etag += '-gz'
+        self.response.headers['ETag'] = '"%s"' % etag
+        self.response.headers['Cache-Control'] = (
+            'public, max-age=%d' % CATALOG_MAX_AGE)
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return
+
+        self.response.headers['Content-Type'] = 'application/json'
+        if gzipped:
+            self.response.headers['Content-Encoding'] = 'gzip'
+            self.response.write(data)
+        else:
+            self.response.write(gunzip(data))
+
+
+class StatsHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Report call counts and p50/p95/p99 of wall time, datastore
+        RPCs, memcache hits/misses and items returned per method."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report(), indent=1, sort_keys=True))
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Report hit/miss counts of the getConference cache per level."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(CONFERENCE_FORM_CACHE.stats()))
+
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Send digests of the queued Conference creation confirmations."""
+        sendConfirmations()
+        self.response.set_status(204)
+
+
+# Confirmations are queued in the confirmation-email pull queue now; this
+# only sends those pushed as tasks before that.
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
+    @instrumented
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -34,32 +118,115 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Copy a conference's sharded seat count onto the Conference
+        and update the nearly sold out conferences."""
+        conf = syncSeatsAvailable(
+            ndb.Key(urlsafe=self.request.get('conference_key')))
+        if conf:
+            ConferenceApi._updateNearlySoldOut(conf)
+        self.response.set_status(204)
+
+
+class AddSpeakerSessionsHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Add newly created sessions to their speakers' Speakers."""
+        session_keys = [ndb.Key(urlsafe=session_key) for session_key in
+                        self.request.get_all('session_keys')]
+        addSessions([session for session in ndb.get_multi(session_keys)
+                     if session])
+        self.response.set_status(204)
+
+
+class BackfillSpeakersHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Start adding all stored sessions to their speakers' Speakers."""
+        taskqueue.add(url='/admin/backfill_speakers')
+        self.response.set_status(202)
+
+    @instrumented
+    def post(self):
+        """Add a batch of sessions to their Speakers and queue the task
+        for the next batch."""
+        cursor = backfillSpeakers(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                          url='/admin/backfill_speakers')
+        self.response.set_status(204)
+
+
+class MigrateDurationsHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Start setting the minutes and end time of all stored
+        sessions."""
+        taskqueue.add(url='/admin/migrate_durations')
+        self.response.set_status(202)
+
+    @instrumented
+    def post(self):
+        """Set the minutes and end time of a batch of sessions and queue
+        the task for the next batch."""
+        cursor = migrateDurations(self.request.get('cursor') or None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                          url='/admin/migrate_durations')
+        self.response.set_status(204)
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Register waiters of a conference for the seats it has left."""
+        safe_key = self.request.get('conference_key')
+        if ConferenceApi._promoteWaitlist(ndb.Key(urlsafe=safe_key)):
+            taskqueue.add(params={'conference_key': safe_key},
+                          url='/tasks/promote_waitlist')
+        self.response.set_status(204)
+
+
+class SendWaitlistEmailHandler(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Email a waiter registered for a conference from its
+        waitlist."""
+        sendPromotion(self.request.get('email'),
+                      self.request.get('conference'))
+        self.response.set_status(204)
+
+
 # This task will set featured speaker and assosiated sessions in memcache
 class Featured_Speaker(webapp2.RequestHandler):
 
+    @instrumented
     def post(self):
         """Make a speaker a feature speaker if he/she presents more than
         once at a conference"""
         safe_key = self.request.get('conference_key')
-        conf = ndb.Key(urlsafe=safe_key).get()
-
-        # Retrieve Conference ID
-        c_key = conf.key
+        c_key = ndb.Key(urlsafe=safe_key)
 
         # Retrieve featured speaker
         speaker = self.request.get('speaker')
 
-        # Find sessions associated with featured speaker
-        sessions = Session.query(ancestor=c_key)
-        # Return the number of times that the speaker is speaking
-        num_of_times_speaking = sessions.filter(
-            Session.speaker == speaker).count()
-        if num_of_times_speaking > 1:
-            session_names = sessions.filter(Session.speaker == speaker)
+        # Sessions associated with featured speaker, as indexed when they
+        # were created
+        index = ndb.Key(SpeakerIndex, speaker, parent=c_key).get()
+        # Check the number of times that the speaker is speaking
+        if index and len(index.sessionNames) > 1:
             featured_speaker = '%s %s\n %s %s' % (
                 'New Featured Speaker is: ', speaker,
                 'Presenting on the following topics:\n',
-                ', \n'.join(name.name for name in session_names))
+                ', \n'.join(index.sessionNames))
 
             # Set featured speaker in memcache
             memcache.set(MEMCACHE_FEATURED_SPEAKER, featured_speaker)
@@ -68,6 +235,17 @@ class Featured_Speaker(webapp2.RequestHandler):
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
+    ('/crons/build_catalog', BuildCatalogHandler),
+    ('/catalog', CatalogHandler),
+    ('/admin/stats', StatsHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/featured_speaker', Featured_Speaker),
+    ('/tasks/sync_seats_available', SyncSeatsAvailableHandler),
+    ('/tasks/add_speaker_sessions', AddSpeakerSessionsHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/send_waitlist_email', SendWaitlistEmailHandler),
+    ('/admin/backfill_speakers', BackfillSpeakersHandler),
+    ('/admin/migrate_durations', MigrateDurationsHandler),
 ], debug=True)
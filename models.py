@@ -9,13 +9,58 @@ from google.appengine.ext import ndb
 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
+    # nearly every endpoint loads the caller's Profile by key, so keep it
+    # in ndb's per-request cache and in memcache (ndb writes through on put)
+    _use_cache = True
+    _use_memcache = True
+
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    # legacy wishlist, moved to WishlistEntry children on first use
     wishlistSessionKeys = ndb.StringProperty(repeated=True)
 
 
+# Wishlisted session of a Profile, as a child of the Profile keyed by the
+# websafe session key, so each session is in a wishlist at most once.
+# typeOfSession and speaker are copied from the Session so the wishlist
+# can be filtered by query, and its name and interval (see schedule.py) so
+# conflicts are found without reading the sessions.
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- a session in a user's wishlist"""
+    typeOfSession = ndb.StringProperty()
+    speaker = ndb.StringProperty()
+    added = ndb.DateTimeProperty(auto_now_add=True)
+    name = ndb.StringProperty(indexed=False)
+    # minutes after midnight; unset if the session has no interval
+    date = ndb.DateProperty(indexed=False)
+    startMinutes = ndb.IntegerProperty(indexed=False)
+    endMinutes = ndb.IntegerProperty(indexed=False)
+    # False for entries added before the interval was copied
+    intervalCached = ndb.BooleanProperty(default=False, indexed=False)
+
+
+# The entity group of a conference's WaitlistEntries, apart from the
+# conference's own so joining does not contend with registrations. Only
+# its key is used; it is never stored.
+class Waitlist(ndb.Model):
+    """Waitlist -- parent of the WaitlistEntries of a conference"""
+
+
+# A user waiting for a seat at a sold out conference, keyed by user as a
+# child of the conference's Waitlist, so whether anyone waits is read by a
+# strongly consistent ancestor query; see waitlist.py. The Profile's name
+# and email are copied for waiters whose Profile is not stored yet.
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat at a conference"""
+    conference = ndb.KeyProperty(kind='Conference')
+    joined = ndb.DateTimeProperty(auto_now_add=True)
+    profile = ndb.KeyProperty(kind='Profile', indexed=False)
+    displayName = ndb.StringProperty(indexed=False)
+    mainEmail = ndb.StringProperty(indexed=False)
+
+
 # needed for conference registration
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -70,7 +115,45 @@ class Conference(ndb.Model):
     month = ndb.IntegerProperty()
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
+    # snapshot of the sharded seat count, see seats.py
     seatsAvailable = ndb.IntegerProperty()
+    seatShards = ndb.IntegerProperty(indexed=False)
+
+
+# Available seats are split across several root SeatShard entities so
+# registrations for one conference do not all write the same entity group.
+class SeatShard(ndb.Model):
+    """SeatShard -- one shard of a conference's available seats"""
+    seatsAvailable = ndb.IntegerProperty(default=0, indexed=False)
+
+
+# There is a single NearlySoldOut entity, kept up to date as seat counts
+# are synced (see seats.py), from which the announcement is built.
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- conferences with few seats left"""
+    # conference name by websafe conference key
+    conferences = ndb.JsonProperty()
+    # bumped by every write, so announcements cached from it keep in order
+    version = ndb.IntegerProperty(indexed=False, default=0)
+
+
+# Snapshot of the upcoming conferences listing, rebuilt by cron and
+# served as is to unfiltered listings, see catalog.py. The gzipped JSON
+# is split across CatalogChunks, as an entity or memcache value holds
+# at most 1MB.
+class CatalogSnapshot(ndb.Model):
+    """CatalogSnapshot -- current version of the catalog"""
+    # hash of the uncompressed JSON, used as its ETag
+    etag = ndb.StringProperty(indexed=False)
+    # number of CatalogChunks holding this version
+    chunks = ndb.IntegerProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class CatalogChunk(ndb.Model):
+    """CatalogChunk -- part of the gzipped JSON ConferenceForms of the
+    catalog, a child of the CatalogSnapshot keyed by etag and index"""
+    data = ndb.BlobProperty()
 
 
 class ConferenceForm(messages.Message):
@@ -87,11 +170,16 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    # version of the conference, for ifNoneMatch on getConference
+    etag = messages.StringField(13)
+    # True, with no other fields, if the client's copy is current
+    notModified = messages.BooleanField(14)
 
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class ConferenceQueryForm(messages.Message):
@@ -105,11 +193,37 @@ class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form
     message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    # ConferenceForm fields to return; all of them if empty
+    fields = messages.StringField(4, repeated=True)
+
+
+class ConferenceKeysForm(messages.Message):
+    """ConferenceKeysForm -- multiple websafe Conference keys inbound form
+    message"""
+    websafeConferenceKeys = messages.StringField(1, repeated=True)
+
+
+class RegistrationResult(messages.Message):
+    """RegistrationResult -- outbound registration result for one
+    Conference; error says why registered is False"""
+    websafeConferenceKey = messages.StringField(1)
+    registered = messages.BooleanField(2)
+    error = messages.StringField(3)
+
+
+class RegistrationResults(messages.Message):
+    """RegistrationResults -- multiple RegistrationResult outbound form
+    message"""
+    items = messages.MessageField(RegistrationResult, 1, repeated=True)
 
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
 # Sessions models
@@ -127,6 +241,44 @@ class Session(ndb.Model):
     date = ndb.DateProperty()
     # (in 24 hour notation so it can be ordered).
     startTime = ndb.TimeProperty()
+    # duration read as minutes, and the end time it gives, so sessions can
+    # be searched by them; unset if duration cannot be read
+    durationMinutes = ndb.IntegerProperty()
+    endTime = ndb.TimeProperty()
+
+
+# Sessions of one speaker at a conference, in creation order. Keyed by
+# speaker as a child of the Conference, so it is updated in the same
+# transaction as the Session it indexes.
+class SpeakerIndex(ndb.Model):
+    """SpeakerIndex -- a speaker's sessions at one conference"""
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+
+
+# A conference's sessions as sent by getConferenceSessions, one AgendaDay
+# per day sorted by start time, as children of the Conference so they are
+# updated in the same transaction as the sessions; the Agenda marks them
+# as built, even for a conference without sessions. See agenda.py.
+class Agenda(ndb.Model):
+    """Agenda -- marks a conference's AgendaDays as built"""
+    built = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class AgendaDay(ndb.Model):
+    """AgendaDay -- SessionForm fields of a conference's sessions on one
+    day, keyed by the date"""
+    sessions = ndb.JsonProperty(compressed=True)
+
+
+# Sessions of one speaker across all conferences. A root entity keyed by
+# the normalized speaker name (see speakers.py), so "Jane Doe" and
+# "jane doe " are the same speaker.
+class Speaker(ndb.Model):
+    """Speaker -- a speaker's sessions at all conferences"""
+    # the name as first given for one of the speaker's sessions
+    name = ndb.StringProperty(indexed=False)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True,
+                                  indexed=False)
 
 
 # SessionForm -- maps to corresponding properties
@@ -143,9 +295,35 @@ class SessionForm(messages.Message):
     startTime = messages.StringField(7)
     websafeConferenceKey = messages.StringField(8)
     websafeSessionKey = messages.StringField(9)
+    # duration in minutes, read from duration if not given
+    durationMinutes = messages.IntegerField(10)
+    # set from startTime and the duration; ignored on input
+    endTime = messages.StringField(11)
+
+
+class WishlistConflictForm(messages.Message):
+    """WishlistConflictForm -- outbound pair of overlapping wishlist
+    sessions, the one starting first first"""
+    date = messages.StringField(1)
+    websafeSessionKeys = messages.StringField(2, repeated=True)
+    names = messages.StringField(3, repeated=True)
+    # when both sessions run, in 24 hour notation
+    overlapStart = messages.StringField(4)
+    overlapEnd = messages.StringField(5)
+
+
+class WishlistConflictForms(messages.Message):
+    """WishlistConflictForms -- multiple WishlistConflictForm outbound
+    form message"""
+    items = messages.MessageField(WishlistConflictForm, 1, repeated=True)
 
 
 # Multiple sessionsForm classes can be used for messaging
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    # version of the conference's sessions, for ifNoneMatch
+    etag = messages.StringField(3)
+    # True, with no items, if the client's copy is current
+    notModified = messages.BooleanField(4)
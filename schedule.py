@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+""" Session durations and schedule conflicts
+
+Sessions store their free-form duration read as minutes, and the end time
+it gives, so they can be searched by them; migrateDurations() sets these
+on sessions stored before."""
+
+import heapq
+import re
+from datetime import time
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from agenda import agendaKey
+from models import Session
+from versions import bumpVersions
+from versions import sessionsVersion
+
+# Sessions read per migration task
+MIGRATION_BATCH_SIZE = 500
+
+# a number of hours or minutes; numbers without a unit are whole minutes
+_DURATION_PART = re.compile(
+    r'(\d+(?:\.\d+)?)\s*(h|hrs?|hours?|m|mins?|minutes?)?(?![a-z])')
+_DURATION_CLOCK = re.compile(r'^(\d+):([0-5]\d)$')
+# what may separate the parts, as in "1 hour, 30 min" or "1h and 30m"
+_DURATION_SEPARATORS = re.compile(r'[\s,]|and')
+
+
+def parseDuration(text):
+    """Return a free-form duration such as '60', '90 min', '1h30', '1:30'
+    or '1.5 hours' in whole minutes; None if it cannot be read, e.g. '1.5',
+    which could be hours or minutes."""
+    text = (text or '').strip().lower()
+    match = _DURATION_CLOCK.match(text)
+    if match:
+        minutes = int(match.group(1)) * 60 + int(match.group(2))
+        return minutes or None
+
+    parts = _DURATION_PART.findall(text)
+    if not parts or _DURATION_SEPARATORS.sub(
+            '', _DURATION_PART.sub('', text)):
+        return None
+    minutes = 0
+    for number, unit in parts:
+        if not unit and '.' in number:
+            return None
+        minutes += float(number) * (60 if unit.startswith('h') else 1)
+    return int(round(minutes)) or None
+
+
+def endTime(start, minutes):
+    """Return when a session starting at start and lasting minutes ends;
+    None if either is unknown or it ends after midnight."""
+    if start is None or not minutes:
+        return None
+    end = start.hour * 60 + start.minute + minutes
+    if end >= 24 * 60:
+        return None
+    return time(*divmod(end, 60))
+
+
+def setDuration(session):
+    """Set durationMinutes and endTime of session from its duration and
+    start time, returning whether they changed."""
+    minutes = session.durationMinutes or parseDuration(session.duration)
+    end = endTime(session.startTime, minutes)
+    if (minutes, end) == (session.durationMinutes, session.endTime):
+        return False
+    session.durationMinutes, session.endTime = minutes, end
+    return True
+
+
+def migrateDurations(websafe_cursor=None):
+    """Set durationMinutes and endTime of a batch of stored sessions, from
+    where websafe_cursor left off; return the cursor of the next batch,
+    None once all sessions are done."""
+    sessions, cursor, more = Session.query().order(Session.key).fetch_page(
+        MIGRATION_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=websafe_cursor) if websafe_cursor
+        else None)
+    changed = [session for session in sessions if setDuration(session)]
+    if changed:
+        ndb.put_multi(changed)
+        c_keys = set(session.key.parent() for session in changed)
+        # the agendas are built again, with the new fields, on next read
+        ndb.delete_multi([agendaKey(c_key) for c_key in c_keys])
+        bumpVersions(*[sessionsVersion(c_key.urlsafe()) for c_key in c_keys])
+    return cursor.urlsafe() if more and cursor else None
+
+
+def sessionInterval(session):
+    """Return (date, start, end) of a session, start and end in minutes
+    after midnight; None unless it has a date, start time and readable
+    duration."""
+    minutes = session.durationMinutes or parseDuration(session.duration)
+    if not (session.date and session.startTime and minutes):
+        return None
+    start = session.startTime.hour * 60 + session.startTime.minute
+    return session.date, start, start + minutes
+
+
+def formatMinutes(minutes):
+    """Return minutes after midnight as HH:MM, up to 24:00 for times past
+    the end of the day."""
+    return '%02d:%02d' % divmod(min(minutes, 24 * 60), 60)
+
+
+def findConflicts(intervals):
+    """Return (date, start, end, a, b) for each pair of overlapping
+    intervals (date, start, end, item) on the same date, where start and
+    end bound the overlap and a started no later than b.
+
+    Intervals are half open, so one ending as another starts does not
+    conflict. Each date's intervals are swept in start order keeping a
+    heap of those still running, so this takes O(n log n) plus the
+    number of conflicts."""
+    by_date = {}
+    for interval in intervals:
+        by_date.setdefault(interval[0], []).append(interval)
+
+    conflicts = []
+    for date in sorted(by_date):
+        running = []
+        ordered = sorted(by_date[date], key=lambda interval: interval[1:3])
+        for i, (_, start, end, item) in enumerate(ordered):
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+            for other_end, _, other in running:
+                conflicts.append(
+                    (date, start, min(end, other_end), other, item))
+            heapq.heappush(running, (end, i, item))
+    return conflicts
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+""" Conference search with any combination of filters
+
+The datastore only gets filters its built-in single property indexes can
+serve together: all equality filters, the inequality filters on one
+property, or one '!=' filter. Of these the group matching the fewest
+conferences is run, found by counting each, and the remaining filters
+are applied in memory. A search without filters reads keys only. The
+matching conference keys are cached per filter signature, in chunks so
+that a page reads only the keys around it."""
+
+import hashlib
+import operator
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from versions import bumpVersions
+from versions import getVersion
+
+SEARCH_VERSION = 'conference search'
+
+MEMCACHE_SEARCH_KEY = "CONFERENCE SEARCH %s "
+MEMCACHE_SEARCH_TIME = 600
+# matching keys are cached in chunks of this many, to stay well under the
+# memcache value size limit however many conferences match
+SEARCH_CHUNK_SIZE = 5000
+# the filter groups a search could run are counted up to this many
+# conferences to pick the most selective
+SEARCH_COUNT_LIMIT = 1000
+# a search without filters lists at most this many conferences
+SEARCH_SCAN_LIMIT = 50000
+
+MATCHERS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+
+def _signature(filters):
+    """Return a memcache key part identifying a set of filters."""
+    version = getVersion(SEARCH_VERSION)
+    normalized = sorted((f['field'], f['operator'], f['value'])
+                        for f in filters)
+    return '%s %s' % (version, hashlib.md5(repr(normalized)).hexdigest())
+
+
+def _filterGroups(filters):
+    """Return the groups of filters the datastore can run together."""
+    groups = []
+    equalities = [f for f in filters if f['operator'] == '=']
+    if equalities:
+        groups.append(equalities)
+    ranges = {}
+    for f in filters:
+        if f['operator'] == '!=':
+            groups.append([f])
+        elif f['operator'] != '=':
+            ranges.setdefault(f['field'], []).append(f)
+    groups.extend(ranges[field] for field in sorted(ranges))
+    return groups
+
+
+def _query(filters):
+    """Return a Conference query with filters."""
+    q = Conference.query()
+    for f in filters:
+        q = q.filter(ndb.query.FilterNode(
+            f['field'], f['operator'], f['value']))
+    return q
+
+
+@ndb.tasklet
+def _splitFiltersAsync(filters):
+    """Split filters into those run by the datastore, the most selective
+    group of them, and those applied in memory."""
+    groups = _filterGroups(filters)
+    if not groups:
+        raise ndb.Return(([], filters))
+    run = groups[0]
+    if len(groups) > 1:
+        counts = yield [_query(group).count_async(limit=SEARCH_COUNT_LIMIT)
+                        for group in groups]
+        run = groups[counts.index(min(counts))]
+    raise ndb.Return((run, [f for f in filters if f not in run]))
+
+
+def _matches(conf, filters):
+    """Return True if conf passes all filters. Like the datastore, a
+    repeated property passes if any of its values does."""
+    for f in filters:
+        value = getattr(conf, f['field'])
+        match = MATCHERS[f['operator']]
+        if isinstance(value, list):
+            if not any(match(v, f['value']) for v in value):
+                return False
+        elif not match(value, f['value']):
+            return False
+    return True
+
+
+def _cachedKeys(prefix, offset, limit):
+    """Return (keys, total) of a search from its cached chunks, or None if
+    a chunk needed is not cached."""
+    indexes = set(['0', str(offset // SEARCH_CHUNK_SIZE)])
+    if limit:
+        indexes.add(str((offset + limit - 1) // SEARCH_CHUNK_SIZE))
+    chunks = memcache.get_multi(list(indexes), key_prefix=prefix)
+    if '0' not in chunks:
+        return None
+    total = chunks['0'][0]
+    end = total if limit is None else min(offset + limit, total)
+    if offset >= end:
+        return [], total
+    needed = [str(i) for i in range(offset // SEARCH_CHUNK_SIZE,
+                                    (end - 1) // SEARCH_CHUNK_SIZE + 1)]
+    missing = [i for i in needed if i not in chunks]
+    if missing:
+        chunks.update(memcache.get_multi(missing, key_prefix=prefix))
+        if any(i not in chunks for i in missing):
+            return None
+    start = int(needed[0]) * SEARCH_CHUNK_SIZE
+    keys = [key for i in needed for key in chunks[i][1]]
+    return keys[offset - start:end - start], total
+
+
+def searchConferences(filters, offset=0, limit=None):
+    """Return (keys, total): the keys of conferences matching all filters,
+    ordered by conference name, from offset on and at most limit of them,
+    and the number of conferences matching. Filters are dicts of field,
+    operator and value."""
+    prefix = MEMCACHE_SEARCH_KEY % _signature(filters)
+    cached = _cachedKeys(prefix, offset, limit)
+    if cached is not None:
+        return cached
+
+    datastore_filters, memory_filters = _splitFiltersAsync(
+        filters).get_result()
+    if datastore_filters or memory_filters:
+        confs = [conf for conf in _query(datastore_filters)
+                 if _matches(conf, memory_filters)]
+        confs.sort(key=lambda conf: (conf.name, conf.key))
+        keys = [conf.key for conf in confs]
+    else:
+        keys = Conference.query().order(Conference.name).fetch(
+            SEARCH_SCAN_LIMIT, keys_only=True)
+
+    # every chunk holds the total, so a page needs no other entry
+    memcache.set_multi(
+        dict((str(i), (len(keys), keys[start:start + SEARCH_CHUNK_SIZE]))
+             for i, start in enumerate(
+                 range(0, len(keys), SEARCH_CHUNK_SIZE) or [0])),
+        key_prefix=prefix, time=MEMCACHE_SEARCH_TIME)
+    end = None if limit is None else offset + limit
+    return keys[offset:end], len(keys)
+
+
+def invalidateSearches():
+    """Make cached search results stale, e.g. after a conference is
+    created."""
+    bumpVersions(SEARCH_VERSION)
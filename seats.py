@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+""" Sharded seat counters for conference registration
+
+Registrations take seats from SeatShards; a conference starts with a few
+and gets more when registrations contend for them. Readers never sum the
+shards: they read a memcached sum kept in step by incr/decr, or else the
+Conference's seatsAvailable, which a task syncs from the shards shortly
+after they change."""
+
+import random
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+# shards of a new conference, and the most it may grow to
+NUM_SEAT_SHARDS = 2
+MAX_SEAT_SHARDS = 20
+NEARLY_SOLD_OUT_SEATS = 5
+MEMCACHE_SEATS_KEY = "SEATS AVAILABLE %s"
+# memcached seat sums are only approximately kept in step by incr/decr,
+# so let them expire; the synced count is read until the next sync
+MEMCACHE_SEATS_TIME = 60
+# seconds whose seat changes of a conference are synced by one task
+SEATS_SYNC_INTERVAL = 10
+
+
+def seatShardKeys(conf):
+    """Return the SeatShard keys of a conference."""
+    wsck = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i))
+            for i in range(conf.seatShards or 0)]
+
+
+def newSeatShards(conf, seats, num_shards=NUM_SEAT_SHARDS):
+    """Split seats across new SeatShard entities and set conf.seatShards.
+
+    The caller is responsible for putting the shards."""
+    conf.seatShards = max(1, min(num_shards, seats))
+    base, extra = divmod(seats, conf.seatShards)
+    return [SeatShard(key=key,
+                      seatsAvailable=base + (1 if i < extra else 0))
+            for i, key in enumerate(seatShardKeys(conf))]
+
+
+@ndb.transactional(xg=True)
+def _initSeatShards(c_key):
+    conf = c_key.get()
+    if not conf.seatShards:
+        shards = newSeatShards(conf, conf.seatsAvailable or 0)
+        ndb.put_multi([conf] + shards)
+    return conf
+
+
+# The Conference, the shard split and the new shard: three entity groups.
+@ndb.transactional(xg=True)
+def _splitSeatShard(c_key):
+    conf = c_key.get()
+    if conf.seatShards >= MAX_SEAT_SHARDS:
+        return
+    shard = random.choice(seatShardKeys(conf)).get()
+    if not shard or shard.seatsAvailable < 2:
+        return
+    moved = shard.seatsAvailable // 2
+    shard.seatsAvailable -= moved
+    conf.seatShards += 1
+    new = SeatShard(key=seatShardKeys(conf)[-1], seatsAvailable=moved)
+    ndb.put_multi([conf, shard, new])
+
+
+def addSeatShard(c_key):
+    """Move half the seats of a random seat shard of a conference to a
+    new shard, unless it has MAX_SEAT_SHARDS already; used when
+    registrations contend for its shards."""
+    try:
+        _splitSeatShard(c_key)
+    except datastore_errors.TransactionFailedError:
+        # the shard is contended as well; a later registration retries
+        pass
+
+
+def ensureSeatShards(conf):
+    """Return conf, creating its seat shards first if it predates them."""
+    if conf.seatShards:
+        return conf
+    return _initSeatShards(conf.key)
+
+
+def getSeatsAvailable(conf):
+    """Return the number of seats available for a conference."""
+    return getSeatsAvailableMulti([conf])[0]
+
+
+def getSeatsAvailableMulti(confs):
+    """Return the number of seats available for each conference in confs,
+    reading all memcached sums in one batch."""
+    return getSeatsAvailableMultiAsync(confs).get_result()
+
+
+@ndb.tasklet
+def getSeatsAvailableMultiAsync(confs):
+    """Tasklet version of getSeatsAvailableMulti()."""
+    ctx = ndb.get_context()
+    sharded = [conf for conf in confs if conf.seatShards]
+    mc_keys = [MEMCACHE_SEATS_KEY % conf.key.urlsafe() for conf in sharded]
+    # the context batches these into a single memcache RPC
+    values = yield [ctx.memcache_get(mc_key) for mc_key in mc_keys]
+    cached = {mc_key: value for mc_key, value in zip(mc_keys, values)
+              if value is not None}
+    # the synced count of the others; at most SEATS_SYNC_INTERVAL seconds
+    # behind the shards
+    raise ndb.Return([cached.get(MEMCACHE_SEATS_KEY % conf.key.urlsafe(),
+                                 conf.seatsAvailable)
+                      if conf.seatShards else conf.seatsAvailable
+                      for conf in confs])
+
+
+def countSeatsAvailable(conf):
+    """Return the sum of a conference's seat shards, as stored."""
+    return sum(shard.seatsAvailable
+               for shard in ndb.get_multi(seatShardKeys(conf)) if shard)
+
+
+def seatsChanged(confs, deltas):
+    """Apply a delta to the memcached seat sum of each conference in
+    confs, and queue syncing their seatsAvailable from their shards."""
+    missing = []
+    for conf, delta in zip(confs, deltas):
+        mc_key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+        if delta > 0:
+            seats = memcache.incr(mc_key, delta)
+        else:
+            seats = memcache.decr(mc_key, -delta)
+        if seats is None:
+            missing.append(conf)
+    # the writers recompute missing sums, so readers need not
+    shard_keys = [seatShardKeys(conf) for conf in missing]
+    shards = iter(ndb.get_multi(
+        [key for keys in shard_keys for key in keys]))
+    memcache.add_multi(
+        dict((MEMCACHE_SEATS_KEY % conf.key.urlsafe(),
+              sum(shard.seatsAvailable for shard in
+                  (next(shards) for key in keys) if shard))
+             for conf, keys in zip(missing, shard_keys)),
+        time=MEMCACHE_SEATS_TIME)
+
+    # one task per conference for all the changes in a SEATS_SYNC_INTERVAL,
+    # run at its end
+    now = time.time()
+    interval = int(now // SEATS_SYNC_INTERVAL)
+    countdown = (interval + 1) * SEATS_SYNC_INTERVAL - now
+    tasks = [taskqueue.Task(
+        name='sync-seats-%s-%d' % (conf.key.urlsafe(), interval),
+        countdown=countdown, params={'conference_key': conf.key.urlsafe()},
+        url='/tasks/sync_seats_available') for conf in confs]
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # queued by an earlier change; the other tasks are added
+            pass
+
+
+@ndb.transactional
+def _storeSeatsAvailable(c_key, seats):
+    conf = c_key.get()
+    if conf.seatsAvailable != seats:
+        conf.seatsAvailable = seats
+        conf.put()
+    return conf
+
+
+def syncSeatsAvailable(c_key):
+    """Copy the sum of a conference's seat shards onto the Conference
+    entity, where it can be queried, and refresh the memcached sum.
+    Returns the Conference, or None if it does not exist."""
+    conf = c_key.get()
+    if not conf or not conf.seatShards:
+        return conf
+    seats = countSeatsAvailable(conf)
+    conf = _storeSeatsAvailable(c_key, seats)
+    memcache.set(MEMCACHE_SEATS_KEY % c_key.urlsafe(), seats,
+                 time=MEMCACHE_SEATS_TIME)
+    return conf
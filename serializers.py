@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+""" Precompiled copy plans from ndb entities to ProtoRPC messages"""
+
+from operator import attrgetter
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import TeeShirtSize
+
+
+class CopyPlan(object):
+    """CopyPlan -- compiled field converters for one (model, message) pair
+
+    Deciding how each message field is filled is done once, when the plan
+    is built; copying an entity is then a single pass over that list."""
+
+    def __init__(self, model_class, message_class, convert, extra=None):
+        """Build the plan from convert(name, prop), which returns the
+        converter for a message field backed by model property prop, and
+        extra, a dict of converters for message fields with no property
+        of the same name. Converters take the entity and return the
+        field value."""
+        extra = extra or {}
+        self.message_class = message_class
+        self.steps = []
+        for field in message_class.all_fields():
+            if field.name in extra:
+                self.steps.append((field.name, extra[field.name]))
+            elif field.name in model_class._properties:
+                self.steps.append((field.name, convert(
+                    field.name, model_class._properties[field.name])))
+        self.check = any(field.required
+                         for field in message_class.all_fields())
+        self._masks = {}
+
+    def masked(self, fields):
+        """Return a plan filling in only the message fields named in
+        fields, which may leave required fields unset."""
+        fields = frozenset(fields)
+        plan = self._masks.get(fields)
+        if plan is None:
+            plan = CopyPlan.__new__(CopyPlan)
+            plan.message_class = self.message_class
+            plan.steps = [(name, convert) for name, convert in self.steps
+                          if name in fields]
+            plan.check = False
+            plan._masks = {}
+            self._masks[fields] = plan
+        return plan
+
+    def copy(self, entity):
+        """Return a new message filled from entity."""
+        msg = self.message_class()
+        for name, convert in self.steps:
+            setattr(msg, name, convert(entity))
+        if self.check:
+            msg.check_initialized()
+        return msg
+
+    def values(self, entity):
+        """Return the message field values for entity by field name."""
+        return dict((name, convert(entity)) for name, convert in self.steps)
+
+    def copyMulti(self, entities):
+        """Return a new message for each entity in entities."""
+        message_class = self.message_class
+        steps = self.steps
+        check = self.check
+        msgs = []
+        for entity in entities:
+            msg = message_class()
+            for name, convert in steps:
+                setattr(msg, name, convert(entity))
+            if check:
+                msg.check_initialized()
+            msgs.append(msg)
+        return msgs
+
+
+def _str(name):
+    get = attrgetter(name)
+    return lambda entity: str(get(entity))
+
+
+def _conferenceConverter(name, prop):
+    # convert Date to date string; just copy others
+    if name.endswith('Date'):
+        return _str(name)
+    return attrgetter(name)
+
+
+def _sessionConverter(name, prop):
+    # sessions are sent with every property but numbers as a string
+    if isinstance(prop, ndb.IntegerProperty):
+        return attrgetter(name)
+    return _str(name)
+
+
+def _parentUrlsafe():
+    # sessions are mostly copied in batches from one conference, so
+    # remember the last parent rather than encoding it again per session
+    last = [(None, None)]
+
+    def convert(entity):
+        parent = entity.key.parent()
+        key, urlsafe = last[0]
+        if key != parent:
+            urlsafe = parent.urlsafe()
+            last[0] = (parent, urlsafe)
+        return urlsafe
+    return convert
+
+
+def _profileConverter(name, prop):
+    # convert t-shirt string to Enum; just copy others
+    if name == 'teeShirtSize':
+        get = attrgetter(name)
+        return lambda prof: getattr(TeeShirtSize, get(prof))
+    return attrgetter(name)
+
+
+CONFERENCE_PLAN = CopyPlan(
+    Conference, ConferenceForm, _conferenceConverter,
+    {'websafeKey': lambda conf: conf.key.urlsafe()})
+
+SESSION_PLAN = CopyPlan(
+    Session, SessionForm, _sessionConverter,
+    {'websafeSessionKey': lambda session: session.key.urlsafe(),
+     'websafeConferenceKey': _parentUrlsafe()})
+
+PROFILE_PLAN = CopyPlan(Profile, ProfileForm, _profileConverter)
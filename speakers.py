@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+""" Speakers and their sessions across all conferences
+
+Each Speaker is keyed by its normalized name and lists the keys of its
+sessions, so a speaker's sessions are read with one get and one get_multi
+rather than a query over every Session. New sessions are added by a task
+queued in the transaction that stores them; backfillSpeakers() adds the
+sessions stored before that."""
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Session
+from models import Speaker
+
+# Sessions read per backfill task
+BACKFILL_BATCH_SIZE = 500
+
+
+def normalizeSpeaker(name):
+    """Return name lowercased with runs of whitespace made single spaces
+    and stripped."""
+    return ' '.join((name or '').split()).lower()
+
+
+def speakerKey(name):
+    """Return the Speaker key of speaker name, None if name is blank."""
+    normalized = normalizeSpeaker(name)
+    return ndb.Key(Speaker, normalized) if normalized else None
+
+
+@ndb.transactional_tasklet
+def _addSessionKeys(key, name, session_keys):
+    speaker = yield key.get_async()
+    if not speaker:
+        speaker = Speaker(key=key, name=name)
+    known = set(speaker.sessionKeys)
+    # tasks may run more than once, so skip sessions already added
+    new = [s_key for s_key in session_keys if s_key not in known]
+    if new:
+        speaker.sessionKeys.extend(new)
+        yield speaker.put_async()
+
+
+def addSessions(sessions):
+    """Add sessions to the Speakers of their speakers, in one transaction
+    per Speaker missing some of them, all run concurrently."""
+    by_speaker = {}
+    for session in sessions:
+        key = speakerKey(session.speaker)
+        if key:
+            name, session_keys = by_speaker.setdefault(
+                key, (session.speaker.strip(), []))
+            session_keys.append(session.key)
+    # retried tasks and backfill reruns mostly find nothing to add, so
+    # only open transactions for the Speakers missing sessions
+    keys = by_speaker.keys()
+    futures = [_addSessionKeys(key, *by_speaker[key])
+               for key, speaker in zip(keys, ndb.get_multi(keys))
+               if not speaker or
+               not set(by_speaker[key][1]) <= set(speaker.sessionKeys)]
+    for future in futures:
+        future.get_result()
+
+
+def getSpeakerSessions(name):
+    """Return the existing sessions of speaker name, in the order they
+    were added."""
+    key = speakerKey(name)
+    speaker = key.get() if key else None
+    if not speaker:
+        return []
+    return [session for session in ndb.get_multi(speaker.sessionKeys)
+            if session]
+
+
+def backfillSpeakers(websafe_cursor=None):
+    """Add a batch of stored sessions to their Speakers, from where
+    websafe_cursor left off; return the cursor of the next batch, None
+    once all sessions are added."""
+    sessions, cursor, more = Session.query().order(Session.key).fetch_page(
+        BACKFILL_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=websafe_cursor) if websafe_cursor
+        else None)
+    addSessions(sessions)
+    return cursor.urlsafe() if more and cursor else None
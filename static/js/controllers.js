@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $http, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -423,13 +423,24 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * Token for the next page of the conference.queryConferences API, if any.
+     * @type {string}
+     */
+    $scope.nextPageToken = null;
+
     /**
      * Invokes the conference.queryConferences API.
+     *
+     * @param more if true, fetches the next page and appends it to the current results.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (more) {
         var sendFilters = {
             filters: []
         }
+        if (more && $scope.nextPageToken) {
+            sendFilters.pageToken = $scope.nextPageToken;
+        }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
             if (filter.field && filter.operator && filter.value) {
@@ -440,6 +451,10 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        if (!more && sendFilters.filters.length == 0) {
+            $scope.getCatalog();
+            return;
+        }
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -458,7 +473,10 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!more) {
+                            $scope.conferences = [];
+                        }
+                        $scope.nextPageToken = resp.nextPageToken || null;
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
@@ -468,6 +486,31 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             });
     }
 
+    /**
+     * Fetches the snapshot of all upcoming conferences, which the browser
+     * revalidates with its ETag.
+     */
+    $scope.getCatalog = function () {
+        $scope.loading = true;
+        $http.get('/catalog').
+            success(function (data) {
+                $scope.loading = false;
+                $scope.messages = 'Query succeeded : upcoming conferences';
+                $scope.alertStatus = 'success';
+                $log.info($scope.messages);
+                $scope.conferences = data.items || [];
+                $scope.nextPageToken = null;
+                $scope.submitted = true;
+            }).
+            error(function (data, status) {
+                $scope.loading = false;
+                $scope.messages = 'Failed to get the conferences : ' + status;
+                $scope.alertStatus = 'warning';
+                $log.error($scope.messages);
+                $scope.submitted = true;
+            });
+    };
+
     /**
      * Invokes the conference.getConferencesCreated method.
      */
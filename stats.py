@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+""" Aggregated per-method latency and RPC statistics
+
+Methods wrapped with @instrumented record, per call, the wall time, the
+datastore RPCs made, memcache hits and misses, and the number of items
+returned. Each instance adds them to histograms in memory, sharded by
+thread so concurrent requests rarely share a lock, and adds those to
+totals in memcache every STATS_FLUSH_INTERVAL seconds. report() reads the
+totals back as percentiles per method."""
+
+import functools
+import itertools
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_STATS_KEY = "STATS %s %s %d"
+MEMCACHE_STATS_NAMES_KEY = "STATS NAMES"
+# how often each instance adds its histograms to the memcache totals
+STATS_FLUSH_INTERVAL = 60
+NUM_STATS_SHARDS = 8
+METRICS = ('wallMs', 'datastoreRpcs', 'memcacheHits', 'memcacheMisses',
+           'items')
+# histogram buckets hold values up to each bound; the last has no bound
+BUCKET_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                 10000, 20000, 50000)
+PERCENTILES = (50, 95, 99)
+
+# measurements of the calls running in this thread, innermost last, and
+# the shard the thread records them in
+_frames = threading.local()
+_hooked = [None]
+
+
+class _Shard(object):
+    """_Shard -- histogram counts of some of an instance's threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+
+_shards = [_Shard() for _ in range(NUM_STATS_SHARDS)]
+# thread idents are aligned addresses, so threads take shards in turn
+_next_shard = itertools.count()
+_flushed = [time.time()]
+_flush_lock = threading.Lock()
+
+
+def _bucket(value):
+    for i, bound in enumerate(BUCKET_BOUNDS):
+        if value <= bound:
+            return i
+    return len(BUCKET_BOUNDS)
+
+
+def _countRpc(service, call, request, response):
+    """apiproxy post call hook counting RPCs for the running calls."""
+    frames = getattr(_frames, 'stack', None)
+    if not frames:
+        return
+    if service == 'datastore_v3':
+        for frame in frames:
+            frame['datastoreRpcs'] += 1
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        misses = request.key_size() - hits
+        for frame in frames:
+            frame['memcacheHits'] += hits
+            frame['memcacheMisses'] += misses
+
+
+def _installHook():
+    # the proxy is replaced by testbed, so check it is the hooked one
+    apiproxy = apiproxy_stub_map.apiproxy
+    if _hooked[0] is not apiproxy:
+        apiproxy.GetPostCallHooks().Append('stats', _countRpc)
+        _hooked[0] = apiproxy
+
+
+def _record(name, frame):
+    shard = getattr(_frames, 'shard', None)
+    if shard is None:
+        shard = _frames.shard = _shards[next(_next_shard) % NUM_STATS_SHARDS]
+    with shard.lock:
+        for metric in METRICS:
+            key = MEMCACHE_STATS_KEY % (name, metric, _bucket(frame[metric]))
+            shard.counts[key] = shard.counts.get(key, 0) + 1
+    if time.time() - _flushed[0] >= STATS_FLUSH_INTERVAL:
+        flush()
+
+
+def _registerNames(names):
+    """Add names to the list of instrumented methods in memcache."""
+    client = memcache.Client()
+    for _ in range(10):
+        known = client.gets(MEMCACHE_STATS_NAMES_KEY)
+        if known is None:
+            if client.add(MEMCACHE_STATS_NAMES_KEY, sorted(names)):
+                return
+        elif names <= set(known):
+            return
+        elif client.cas(MEMCACHE_STATS_NAMES_KEY,
+                        sorted(names | set(known))):
+            return
+
+
+def flush():
+    """Add this instance's histograms to the memcache totals."""
+    if not _flush_lock.acquire(False):
+        # another thread is flushing
+        return
+    try:
+        _flushed[0] = time.time()
+        counts = {}
+        for shard in _shards:
+            with shard.lock:
+                shard_counts, shard.counts = shard.counts, {}
+            for key, count in shard_counts.items():
+                counts[key] = counts.get(key, 0) + count
+        if counts:
+            memcache.offset_multi(counts, initial_value=0)
+            _registerNames(set(key.split(' ')[1] for key in counts))
+    finally:
+        _flush_lock.release()
+
+
+def instrumented(func):
+    """Decorator recording statistics of each call of a ConferenceApi or
+    request handler method, named <class>.<method>."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        _installHook()
+        frame = dict.fromkeys(METRICS, 0)
+        frames = getattr(_frames, 'stack', None)
+        if frames is None:
+            frames = _frames.stack = []
+        frames.append(frame)
+        started = time.time()
+        try:
+            result = func(self, *args, **kwargs)
+            frame['items'] = len(getattr(result, 'items', None) or [])
+            return result
+        finally:
+            frame['wallMs'] = int((time.time() - started) * 1000)
+            frames.pop()
+            _record('%s.%s' % (type(self).__name__, func.__name__), frame)
+    return wrapper
+
+
+def _percentile(buckets, total, percentile):
+    """Return the bound of the bucket holding the percentile; None for
+    the unbounded last bucket."""
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen * 100 >= total * percentile:
+            return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else None
+
+
+def report():
+    """Return the number of calls and the percentiles of each metric per
+    instrumented method, from the memcache totals."""
+    names = memcache.get(MEMCACHE_STATS_NAMES_KEY) or []
+    num_buckets = len(BUCKET_BOUNDS) + 1
+    keys = [MEMCACHE_STATS_KEY % (name, metric, i)
+            for name in names for metric in METRICS
+            for i in range(num_buckets)]
+    counts = memcache.get_multi(keys)
+
+    stats = {}
+    for name in names:
+        method = {}
+        for metric in METRICS:
+            buckets = [counts.get(MEMCACHE_STATS_KEY % (name, metric, i), 0)
+                       for i in range(num_buckets)]
+            total = sum(buckets)
+            if not total:
+                continue
+            method['calls'] = total
+            method[metric] = dict(
+                ('p%d' % p, _percentile(buckets, total, p))
+                for p in PERCENTILES)
+        if method:
+            stats[name] = method
+    return stats
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+""" Tests of Conference Central on the App Engine SDK's local stubs
+
+Run from the application directory with the path to the App Engine SDK in
+APPENGINE_SDK, e.g.
+`APPENGINE_SDK=~/google_appengine python -m unittest discover tests`."""
+
+import os
+import unittest
+
+from benchmarks import setupSdk
+
+setupSdk(os.path.expanduser(os.environ['APPENGINE_SDK']))
+
+
+def activateStubs():
+    """Activate the benchmarks' testbed with ndb's in-context cache off,
+    so each call reads what the previous ones stored, returning it to
+    deactivate."""
+    import benchmarks
+    from google.appengine.ext import ndb
+
+    bed = benchmarks.activateStubs()
+    ndb.get_context().set_cache_policy(False)
+    return bed
+
+
+class StubTestCase(unittest.TestCase):
+    """A test on fresh stubs, with the push tasks it queues run on
+    demand."""
+
+    def setUp(self):
+        from google.appengine.ext import testbed
+
+        self.bed = activateStubs()
+        self.taskqueue = self.bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def runTasks(self):
+        """Run the push tasks queued so far, and those they queue."""
+        import main
+        import webapp2
+
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks(queue_names=['default'])
+            if not tasks:
+                return
+            self.taskqueue.FlushQueue('default')
+            for task in tasks:
+                response = webapp2.Request.blank(
+                    task.url, POST=task.payload, headers={
+                        'Content-Type': 'application/x-www-form-urlencoded'}
+                ).get_response(main.app)
+                self.assertLess(response.status_int, 300, task.url)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+""" The nearly sold out conferences index against a full scan"""
+
+import random
+import unittest
+
+# first, to put the SDK on sys.path
+from tests import StubTestCase
+
+from benchmarks import asUser
+from conference import ANNOUNCEMENT_GET_REQUEST
+from conference import CONF_GET_REQUEST
+from conference import ConferenceApi
+from conference import NEARLY_SOLD_OUT_KEY
+from models import Conference
+from models import ConferenceForm
+from models import ConflictException
+from models import NearlySoldOut
+from seats import NEARLY_SOLD_OUT_SEATS
+from seats import getSeatsAvailableMulti
+
+
+class NearlySoldOutTest(StubTestCase):
+
+    def createConferences(self, seats):
+        asUser('organizer@example.com')
+        for i, max_attendees in enumerate(seats):
+            ConferenceApi().createConference(ConferenceForm(
+                name='Conference %d' % i, maxAttendees=max_attendees))
+        return Conference.query().fetch()
+
+    def fullScan(self):
+        """Return the names of the conferences with 1 to
+        NEARLY_SOLD_OUT_SEATS seats left by websafe key, counting the
+        seats of every conference from its shards."""
+        confs = Conference.query().fetch()
+        return {conf.key.urlsafe(): conf.name for conf, seats in zip(
+                confs, getSeatsAvailableMulti(confs))
+                if 0 < seats <= NEARLY_SOLD_OUT_SEATS}
+
+    def testIndexMatchesFullScan(self):
+        rand = random.Random(5)
+        confs = self.createConferences([rand.randint(1, 12)
+                                        for _ in range(30)])
+        self.runTasks()
+        requests = [CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=conf.key.urlsafe()) for conf in confs]
+        for i in range(300):
+            asUser('attendee%d@example.com' % rand.randint(0, 40))
+            request = rand.choice(requests)
+            try:
+                if rand.random() < 0.7:
+                    ConferenceApi().registerForConference(request)
+                else:
+                    ConferenceApi().unregisterFromConference(request)
+            except ConflictException:
+                pass
+            if i % 25 == 0:
+                self.runTasks()
+        self.runTasks()
+
+        scanned = self.fullScan()
+        self.assertTrue(scanned)
+        self.assertEqual(NEARLY_SOLD_OUT_KEY.get().conferences, scanned)
+        self.assertEqual(ConferenceApi._checkNearlySoldOut()[2], [])
+
+    def testCacheAnnouncementRepairsIndex(self):
+        confs = self.createConferences([3, 4, 50])
+        self.runTasks()
+        index = NEARLY_SOLD_OUT_KEY.get()
+        wsck = confs[0].key.urlsafe()
+        del index.conferences[wsck]
+        index.conferences['gone'] = 'Deleted conference'
+        index.put()
+
+        ConferenceApi._cacheAnnouncement()
+        self.assertEqual(NEARLY_SOLD_OUT_KEY.get().conferences,
+                         self.fullScan())
+
+    def testReconcileKeepsConcurrentUpdates(self):
+        confs = self.createConferences([3, 4])
+        self.runTasks()
+        scanned, indexed, stale = ConferenceApi._checkNearlySoldOut()
+        # the index loses one conference; the check saw it in both, so
+        # its update after the check stands
+        sold_out = confs[0]
+        sold_out.seatsAvailable = 0
+        ConferenceApi._updateNearlySoldOutTxn(sold_out)
+        index = ConferenceApi._reconcileNearlySoldOutTxn(
+            scanned, indexed, [sold_out.key.urlsafe()])
+        self.assertNotIn(sold_out.key.urlsafe(), index.conferences)
+        self.assertIn(confs[1].key.urlsafe(), index.conferences)
+
+    def testAnnouncementsKeepInOrder(self):
+        confs = self.createConferences([3])
+        self.runTasks()
+        newer = NEARLY_SOLD_OUT_KEY.get()
+        older = NearlySoldOut(key=NEARLY_SOLD_OUT_KEY, conferences={},
+                              version=newer.version - 1)
+        # the older update reaches memcache last
+        ConferenceApi._setAnnouncement(newer)
+        ConferenceApi._setAnnouncement(older)
+        announcement = ConferenceApi().getAnnouncement(
+            ANNOUNCEMENT_GET_REQUEST.combined_message_class()).data
+        self.assertIn(confs[0].name, announcement)
+
+
+if __name__ == '__main__':
+    unittest.main()
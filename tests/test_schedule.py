@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+""" Reading session durations and finding wishlist conflicts"""
+
+import unittest
+from datetime import date
+
+# first, to put the SDK on sys.path
+from tests import StubTestCase
+
+from protorpc import message_types
+
+from benchmarks import asUser
+from conference import WISH_LIST_GET_REQUEST
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import SessionForm
+from schedule import findConflicts
+from schedule import parseDuration
+
+
+class ParseDurationTest(unittest.TestCase):
+
+    def testReadsMinutes(self):
+        for text, minutes in [
+                ('60', 60),
+                (' 45 MINUTES ', 45),
+                ('90 min', 90),
+                ('1 hour', 60),
+                ('1h30', 90),
+                ('1h 30m', 90),
+                ('1 hour, 30 min', 90),
+                ('1h and 30m', 90),
+                ('1.5 hours', 90),
+                ('0.25h', 15),
+                ('1:30', 90),
+                ('0:45', 45),
+                ('10:00', 600)]:
+            self.assertEqual(parseDuration(text), minutes, text)
+
+    def testRefusesWhatItCannotRead(self):
+        for text in [None, '', '  ', 'soon', '2 days', '1.5', '1:75',
+                     '1:3', 'about 60', '60 min or so', '0', '0:00', '0h']:
+            self.assertIsNone(parseDuration(text), text)
+
+
+class FindConflictsTest(unittest.TestCase):
+
+    day = date(2026, 1, 1)
+    next_day = date(2026, 1, 2)
+
+    def testNoConflicts(self):
+        self.assertEqual(findConflicts([]), [])
+        # back to back, and the same time on another day
+        self.assertEqual(findConflicts([
+            (self.day, 540, 600, 'a'),
+            (self.day, 600, 660, 'b'),
+            (self.next_day, 540, 600, 'c'),
+        ]), [])
+
+    def testOverlapsInStartOrder(self):
+        conflicts = findConflicts([
+            (self.day, 600, 660, 'late'),
+            (self.day, 540, 720, 'long'),
+            (self.day, 630, 640, 'short'),
+            (self.next_day, 0, 60, 'alone'),
+        ])
+        self.assertEqual(sorted(conflicts), sorted([
+            (self.day, 600, 660, 'long', 'late'),
+            (self.day, 630, 640, 'long', 'short'),
+            (self.day, 630, 640, 'late', 'short'),
+        ]))
+
+    def testEqualIntervals(self):
+        conflicts = findConflicts([
+            (self.day, 540, 600, 'a'),
+            (self.day, 540, 600, 'b'),
+        ])
+        self.assertEqual(len(conflicts), 1)
+        date_, start, end, first, second = conflicts[0]
+        self.assertEqual((date_, start, end), (self.day, 540, 600))
+        self.assertEqual(set([first, second]), set(['a', 'b']))
+
+    def testEveryPairOfOverlaps(self):
+        # n sessions all running at once conflict in every pair
+        intervals = [(self.day, i, 100 + i, i) for i in range(10)]
+        conflicts = findConflicts(intervals)
+        self.assertEqual(len(conflicts), 10 * 9 / 2)
+        self.assertTrue(all(first < second
+                            for _, _, _, first, second in conflicts))
+
+
+class WishlistConflictsTest(StubTestCase):
+
+    def testConflictsOfWishlist(self):
+        asUser('organizer@example.com')
+        api = ConferenceApi()
+        api.createConference(ConferenceForm(name='Conference',
+                                            maxAttendees=10))
+        wsck = Conference.query().get().key.urlsafe()
+        sessions = [api.createSession(SessionForm(
+            name=name, startTime=start, duration=duration, date='2026-01-01',
+            websafeConferenceKey=wsck))
+            for name, start, duration in [('Keynote', '09:00', '1h30'),
+                                          ('Workshop', '10:00', '2 hours'),
+                                          ('Lunch', '12:00', '60')]]
+        add = WISH_LIST_GET_REQUEST.combined_message_class
+        for session in sessions:
+            api.addSessionToWishlist(add(SessionKey=session.websafeSessionKey))
+
+        conflicts = api.getWishlistConflicts(
+            message_types.VoidMessage()).items
+        self.assertEqual([(c.names, c.overlapStart, c.overlapEnd)
+                          for c in conflicts],
+                         [([u'Keynote', u'Workshop'], '10:00', '10:30')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+""" Waitlist promotion in the order users joined"""
+
+import unittest
+
+# first, to put the SDK on sys.path
+from tests import StubTestCase
+
+from google.appengine.ext import testbed
+
+from benchmarks import asUser
+from conference import CONF_GET_REQUEST
+from conference import WAITLIST_FIRST
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import ConflictException
+from models import Profile
+from models import WaitlistEntry
+from waitlist import _waitlistKey
+
+
+class WaitlistTest(StubTestCase):
+
+    def setUp(self):
+        super(WaitlistTest, self).setUp()
+        self.mail = self.bed.get_stub(testbed.MAIL_SERVICE_NAME)
+        asUser('organizer@example.com')
+        ConferenceApi().createConference(ConferenceForm(
+            name='Conference', maxAttendees=1))
+        self.conf = Conference.query().get()
+        self.request = CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.conf.key.urlsafe())
+        self.runTasks()
+
+    def call(self, email, method):
+        asUser(email)
+        return getattr(ConferenceApi(), method)(self.request).data
+
+    def attendees(self):
+        wsck = self.conf.key.urlsafe()
+        return sorted(prof.mainEmail for prof in Profile.query()
+                      if wsck in prof.conferenceKeysToAttend)
+
+    def waiting(self):
+        return [entry.mainEmail for entry in WaitlistEntry.query(
+                ancestor=_waitlistKey(self.conf.key.urlsafe())).order(
+                WaitlistEntry.joined)]
+
+    def testPromotesInJoinOrder(self):
+        self.assertTrue(self.call('holder@example.com',
+                                  'registerForConference'))
+        waiters = ['waiter%d@example.com' % i for i in range(3)]
+        for email in waiters:
+            self.assertTrue(self.call(email, 'joinWaitlist'))
+        self.assertFalse(self.call(waiters[0], 'joinWaitlist'))
+
+        self.assertTrue(self.call('holder@example.com',
+                                  'unregisterFromConference'))
+        # the seat given back is for the waitlist, not a newcomer
+        with self.assertRaises(ConflictException) as raised:
+            self.call('newcomer@example.com', 'registerForConference')
+        self.assertEqual(str(raised.exception), WAITLIST_FIRST)
+        self.runTasks()
+        self.assertEqual(self.attendees(), [waiters[0]])
+        self.assertEqual(self.waiting(), waiters[1:])
+        self.assertEqual([message.to for message in
+                          self.mail.get_sent_messages()], [waiters[0]])
+
+        self.call(waiters[0], 'unregisterFromConference')
+        self.runTasks()
+        self.assertEqual(self.attendees(), [waiters[1]])
+        self.assertEqual(self.waiting(), waiters[2:])
+
+    def testSkipsThoseWhoLeft(self):
+        self.call('holder@example.com', 'registerForConference')
+        for i in range(3):
+            self.call('waiter%d@example.com' % i, 'joinWaitlist')
+        self.assertTrue(self.call('waiter0@example.com', 'leaveWaitlist'))
+        self.assertFalse(self.call('waiter0@example.com', 'leaveWaitlist'))
+
+        self.call('holder@example.com', 'unregisterFromConference')
+        self.runTasks()
+        self.assertEqual(self.attendees(), ['waiter1@example.com'])
+        self.assertEqual(self.waiting(), ['waiter2@example.com'])
+
+    def testJoinRefusedWhileSeatsLeft(self):
+        with self.assertRaises(ConflictException):
+            self.call('waiter0@example.com', 'joinWaitlist')
+
+
+if __name__ == '__main__':
+    unittest.main()
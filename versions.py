@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+""" Version tags for conditional reads
+
+Each versioned resource has a memcache counter, bumped whenever it is
+written, whose value is handed to clients as its ETag. A counter that is
+missing, e.g. after eviction, restarts from the current time in
+microseconds, so it does not repeat a tag handed out before."""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_VERSION_KEY = "VERSION %s"
+
+
+def _newVersion():
+    return int(time.time() * 1000000)
+
+
+def getVersion(name):
+    """Return the current version tag of resource name."""
+    key = MEMCACHE_VERSION_KEY % name
+    version = memcache.get(key)
+    if version is None:
+        version = _newVersion()
+        if not memcache.add(key, version):
+            version = memcache.get(key) or version
+    return str(version)
+
+
+def bumpVersions(*names):
+    """Start a new version of each resource in names."""
+    if names:
+        memcache.offset_multi(
+            dict.fromkeys([MEMCACHE_VERSION_KEY % name for name in names],
+                          1),
+            initial_value=_newVersion())
+
+
+def requestTag(version, *params):
+    """Return the ETag of a response built from version of a resource for
+    a request with params, so that other pages or filters of the same
+    version are tagged differently."""
+    return '%s-%s' % (version, hashlib.md5(repr(params)).hexdigest()[:8])
+
+
+def conferenceVersion(wsck):
+    """Return the name of the version of a conference's ConferenceForm."""
+    return 'conference %s' % wsck
+
+
+def sessionsVersion(wsck):
+    """Return the name of the version of a conference's sessions."""
+    return 'sessions %s' % wsck
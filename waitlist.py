@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+""" Waitlists of sold out conferences
+
+Users who find a conference sold out join its waitlist rather than retry
+registration, which is refused while anyone waits. The entries of a
+conference share an entity group, so ancestor queries tell registration
+and joining alike whether anyone waits, and in which order. When a seat
+is given back, a task promotes waiters in the order they joined, each in
+a cross group transaction that takes a seat from a seat shard, adds the
+conference to the waiter's Profile, removes the WaitlistEntry and queues
+the waiter's notification."""
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Waitlist
+from models import WaitlistEntry
+from seats import seatShardKeys
+
+# waiters promoted per task; the task is queued again if there may be more
+MAX_PROMOTIONS = 20
+
+
+def _waitlistKey(wsck):
+    return ndb.Key(Waitlist, wsck)
+
+
+def waitlistKey(wsck, p_key):
+    """Return the WaitlistEntry key of a Profile at a conference."""
+    return ndb.Key(WaitlistEntry, p_key.id(), parent=_waitlistKey(wsck))
+
+
+@ndb.tasklet
+def hasWaitersAsync(c_key):
+    """Return whether anyone waits for a seat at a conference."""
+    entry_key = yield WaitlistEntry.query(
+        ancestor=_waitlistKey(c_key.urlsafe())).get_async(keys_only=True)
+    raise ndb.Return(entry_key is not None)
+
+
+@ndb.transactional
+def addWaiter(wsck, profile):
+    """Add profile to the end of the waitlist of a conference, returning
+    False if it is on it already."""
+    key = waitlistKey(wsck, profile.key)
+    if key.get():
+        return False
+    WaitlistEntry(key=key, conference=ndb.Key(urlsafe=wsck),
+                  profile=profile.key, displayName=profile.displayName,
+                  mainEmail=profile.mainEmail).put()
+    return True
+
+
+@ndb.transactional
+def removeWaiter(wsck, p_key):
+    """Remove a Profile from the waitlist of a conference, returning False
+    if it was not on it."""
+    key = waitlistKey(wsck, p_key)
+    if not key.get():
+        return False
+    key.delete()
+    return True
+
+
+# The entry, the waiter's Profile and one seat shard: three entity groups.
+@ndb.transactional(xg=True)
+def _promote(entry_key, shard_key, wsck, name):
+    """Give the waiter of entry_key a seat from shard_key. Returns True if
+    they were registered, None if they left the waitlist or were already
+    registered, False if the shard has no seat to give."""
+    entry = entry_key.get()
+    if not entry:
+        return None
+    prof, shard = ndb.get_multi([entry.profile, shard_key])
+    if not prof:
+        prof = Profile(key=entry.profile, displayName=entry.displayName,
+                       mainEmail=entry.mainEmail)
+    if wsck in prof.conferenceKeysToAttend:
+        entry_key.delete()
+        return None
+    if shard.seatsAvailable <= 0:
+        return False
+
+    prof.conferenceKeysToAttend.append(wsck)
+    shard.seatsAvailable -= 1
+    ndb.put_multi([prof, shard])
+    entry_key.delete()
+    taskqueue.add(params={'email': prof.mainEmail, 'conference': name},
+                  url='/tasks/send_waitlist_email', transactional=True)
+    return True
+
+
+def promoteWaiters(conf):
+    """Register the longest waiting users of conf for the seats it has
+    left, up to MAX_PROMOTIONS of them. Returns (promoted, more): how many
+    were registered, and whether seats and waiters may both be left."""
+    wsck = conf.key.urlsafe()
+    shards = ndb.get_multi(seatShardKeys(conf))
+    free = [shard.key for shard in shards
+            if shard and shard.seatsAvailable > 0]
+    if not free:
+        return 0, False
+    entry_keys = WaitlistEntry.query(ancestor=_waitlistKey(wsck)).order(
+        WaitlistEntry.joined).fetch(MAX_PROMOTIONS, keys_only=True)
+
+    promoted = 0
+    for entry_key in entry_keys:
+        result = False
+        while free and result is False:
+            result = _promote(entry_key, free[-1], wsck, conf.name)
+            if result is False:
+                free.pop()
+        if not free:
+            break
+        if result:
+            promoted += 1
+    return promoted, bool(free) and len(entry_keys) == MAX_PROMOTIONS